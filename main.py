@@ -7,6 +7,24 @@ import asyncio
 import os
 import logging
 import json
+import csv
+import difflib
+import heapq
+import io
+import itertools
+import random
+import re
+import signal
+import unicodedata
+import sqlite3
+import socket
+import sys
+import threading
+import time
+import traceback
+from array import array
+from collections import deque
+from contextlib import closing
 from datetime import datetime
 import pytz
 from dotenv import load_dotenv
@@ -20,7 +38,27 @@ EMAIL = os.getenv('COC_EMAIL')
 PASSWORD = os.getenv('COC_PASSWORD')
 # Garante que a porta seja lida do ambiente ou use 8080 como padrão
 PORT = int(os.getenv('PORT', 8080))
-
+# --- Modo Multi-Worker (opcional) ---
+# SHARD_COUNT: total de shards do gateway; SHARD_IDS: shards deste processo (ex: "0,1")
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', 0)) or None
+SHARD_IDS = [int(s) for s in os.getenv('SHARD_IDS', '').split(',') if s.strip()] or None
+WORKER_ID = os.getenv('WORKER_ID') or f"{socket.gethostname()}-{os.getpid()}"
+SHARED_STATE_DB = os.getenv('SHARED_STATE_DB', 'clashlog_state.db')
+LEASE_TTL = int(os.getenv('LEASE_TTL', 300)) # Segundos até um lease abandonado expirar
+SWEEP_BUCKETS = max(1, int(os.getenv('SWEEP_BUCKETS', 8))) # Partições da verificação periódica
+# Sufixo estável dos arquivos de estado próprios de cada worker (o WORKER_ID padrão muda a cada reinício)
+WORKER_FILE_SUFFIX = os.getenv('WORKER_ID') or "shards-" + "-".join(str(s) for s in (SHARD_IDS or ["todos"]))
+
+def worker_file(filename):
+    """Com vários workers, cada um grava o próprio estado em memória em `nome.<worker>.json`."""
+    if not SHARD_COUNT:
+        return filename
+    root, ext = os.path.splitext(filename)
+    return f"{root}.{WORKER_FILE_SUFFIX}{ext}"
+# --- Watchdog do Event Loop (segundos) ---
+LOOP_LAG_DEGRADED = float(os.getenv('LOOP_LAG_DEGRADED', 0.25)) # p95 acima disso = degradado
+LOOP_LAG_UNHEALTHY = float(os.getenv('LOOP_LAG_UNHEALTHY', 2.0)) # p99 acima disso = não saudável
+SLOW_CALLBACK_THRESHOLD = float(os.getenv('SLOW_CALLBACK_THRESHOLD', 1.0)) # Loop travado por mais que isso loga stack trace
 
 # --- Validação Inicial das Credenciais ---
 if not TOKEN:
@@ -29,6 +67,9 @@ if not TOKEN:
 if not EMAIL or not PASSWORD:
     print("ERRO CRÍTICO: COC_EMAIL ou COC_PASSWORD não encontrados no arquivo .env")
     exit()
+if SHARD_IDS and not SHARD_COUNT:
+    print("ERRO CRÍTICO: SHARD_IDS definido sem SHARD_COUNT no arquivo .env")
+    exit()
 
 # --- Configuração de Logging ---
 log_formatter = logging.Formatter('%(asctime)s-%(levelname)s-[%(funcName)s]: %(message)s')
@@ -43,9 +84,45 @@ logger.info("Logging configurado.")
 
 # --- Constantes e Arquivos ---
 CONFIG_FILE = "config.json"
-REGISTRATIONS_FILE = "registrations.json"
+REGISTRATIONS_FILE = "registrations.json" # Formato antigo; migrado para SHARED_STATE_DB
 PENDING_APPROVALS_FILE = "pending_approvals.json" # <-- Opcional, mas pode ser útil
+PLAYER_CACHE_FILE = worker_file("player_cache.json")
+WAR_LOG_STATE_FILE = "war_log_state.json" # Compartilhado: só é gravado por quem detém o lease do log de guerras
+ACTIVITY_FILE = worker_file("activity.json")
+WARM_SNAPSHOT_FILE = worker_file("warm_snapshot.json")
 COC_KEY_NAME = "clashlogsbot"
+COC_THROTTLE_LIMIT = 20 # Requisições por segundo permitidas pelo coc.Client
+PLAYER_CACHE_TTL = 6 * 3600 # Após isso o perfil é considerado desatualizado e rebuscado
+PLAYER_CACHE_MAX_AGE = 7 * 24 * 3600 # Após isso o perfil é descartado do cache
+# Intervalo (minutos) de consulta da guerra atual conforme o estado dela
+WAR_POLL_MINUTES = {"preparation": 15, "inWar": 3, "warEnded": 30, "notInWar": 30}
+WAR_LOG_INDEX_SIZE = 30 # Quantas guerras/raids o índice de deduplicação lembra
+# Fila de admissão do /registrar
+ADMISSION_BATCH_WINDOW = 2.0 # Segundos aguardando mais pedidos antes de processar um lote
+ADMISSION_BATCH_MAX = 25
+ADMISSION_QUEUE_MAX = 500
+ADMISSION_DEDUPE_WINDOW = 15 * 60 # Mesmo (usuário, tag) nesse intervalo é ignorado
+ADMISSION_ROSTER_MAX_AGE = 60 # Roster mais novo que isso é reaproveitado entre lotes
+ADMISSION_ROSTER_BUDGET_PER_MIN = 6 # Máximo de get_clan por minuto feitos pela fila
+ADMISSION_RETRY_DELAY = 15
+ADMISSION_PROFILE_TIMEOUT = 5.0
+ADMISSION_MAX_WAIT = 14 * 60 # Tokens de interação do Discord expiram em 15 minutos
+DEFERRED_APPROVAL_MAX_WAIT = 13 * 60 # Idem para /aprovar na fila; contado a partir do comando
+# Importação em massa (/importar)
+IMPORT_MAX_FILE_BYTES = 1024 * 1024
+IMPORT_ROLE_EDIT_DELAY = 0.5 # Pausa entre membros ao aplicar cargos em lote
+IMPORT_FUZZY_MIN_SCORE = 0.8 # Similaridade mínima para sugerir um vínculo por nome
+ACTIVITY_DAYS = 7 # Tamanho da janela (em dias) dos agregados de atividade
+ACTIVITY_FIELDS = ("donations", "received", "trophies")
+ACTIVITY_RANKING_SIZE = 25
+DISCORD_MESSAGE_LIMIT = 1900 # Margem abaixo do limite de 2000 caracteres do Discord
+SWEEP_INTERVAL_HOURS = 1
+SNAPSHOT_INTERVAL_MINUTES = 10
+# Retentativas dentro da verificação periódica para falhas transitórias (segundos)
+SWEEP_RETRY_BASE_DELAY = 5
+SWEEP_RETRY_MAX_DELAY = 120
+SWEEP_RETRY_DEADLINE = 10 * 60 # Por membro, contado a partir da primeira falha
+SWEEP_LEASE_POLL_SECONDS = 30 # Espera quando todos os buckets restantes estão com outros workers
 try:
     TIMEZONE = pytz.timezone('America/Sao_Paulo')
     logger.info(f"Timezone definida para {TIMEZONE}")
@@ -57,7 +134,22 @@ except pytz.UnknownTimeZoneError:
 config = {}
 registrations = {}
 # pending_approvals = {} # <-- Opcional, descomente se usar PENDING_APPROVALS_FILE
+player_cache = {} # tag -> resumo do perfil do jogador (ver cache_player)
+war_log_state = {} # Índice de deduplicação do log de guerras/raids (ver war_log_task)
+activity = {} # tag -> agregados de atividade em arrays de tamanho fixo (ver fold_roster)
+activity_rankings = {} # período -> texto do ranking já calculado para /atividade
+activity_save_lock = None # asyncio.Lock criado no on_ready
+registration_queue = None # asyncio.Queue da fila de admissão, criada no on_ready
+admission_recent = {} # (discord_id, tag) -> time.monotonic() da admissão, para deduplicação
+admission_roster = {"clan": None, "fetched_at": 0.0} # Último roster usado pela fila
+admission_budget = deque() # Horários (monotonic) das buscas de roster no último minuto
+roster_snapshot = {} # Último roster conhecido: {"clan_tag", "name", "fetched_at", "members": {tag: {"name", "role"}}}
+sweep_state = {} # discord_id -> [tag, cargo CoC] na última verificação bem-sucedida
+role_summary = {} # cargo CoC -> {"id", "name"} do cargo Discord, para prévias com o cache do servidor frio
+last_sweep_at = None # time.time() da última verificação periódica concluída
+deferred_approvals = [] # (interaction, usuario, player_tag) aguardando dados ao vivo do CoC
 coc_client = None
+background_tasks = set() # Referências fortes para tarefas criadas com spawn_background
 
 # --- Funções Utilitárias para JSON ---
 def load_json(filename):
@@ -73,14 +165,177 @@ def load_json(filename):
     return {}
 
 def save_json(data, filename):
-    """Salva dados em um arquivo JSON."""
+    """Salva dados em um arquivo JSON de forma atômica (arquivo temporário + os.replace)."""
+    tmp_filename = f"{filename}.{os.getpid()}.{threading.get_ident()}.tmp"
     try:
-        with open(filename, 'w', encoding='utf-8') as f:
+        with open(tmp_filename, 'w', encoding='utf-8') as f:
             json.dump(data, f, indent=4, ensure_ascii=False)
+        # Leitores (e outros processos) veem o arquivo antigo ou o novo, nunca um pela metade
+        os.replace(tmp_filename, filename)
         logger.debug(f"Dados salvos em {filename}")
         return True
     except IOError as e:
         logger.error(f"Erro ao salvar {filename}: {e}")
+        try:
+            os.remove(tmp_filename)
+        except OSError:
+            pass
+        return False
+
+# --- Estado Compartilhado (SQLite) ---
+# Vários workers dividem a verificação periódica em "buckets". Cada bucket só é
+# processado por quem detém o lease dele; leases expiram sozinhos se o worker cair.
+# Os registros também ficam aqui, já que vários processos os alteram.
+def _lease_db():
+    conn = sqlite3.connect(SHARED_STATE_DB, timeout=10.0, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    return conn
+
+def init_shared_store():
+    """Cria as tabelas do banco compartilhado e migra o registrations.json antigo, se houver."""
+    try:
+        with closing(_lease_db()) as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS leases (key TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS registrations (discord_id TEXT PRIMARY KEY, tag TEXT NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS sweep_state (discord_id TEXT PRIMARY KEY, tag TEXT NOT NULL, role TEXT NOT NULL)")
+            if sweep_state and conn.execute("SELECT COUNT(*) FROM sweep_state").fetchone()[0] == 0:
+                # Snapshots antigos guardavam o estado da verificação no JSON
+                with conn:
+                    conn.execute("BEGIN IMMEDIATE")
+                    conn.executemany("INSERT OR IGNORE INTO sweep_state (discord_id, tag, role) VALUES (?, ?, ?)",
+                                     [(d, v[0], v[1]) for d, v in sweep_state.items()])
+            empty = conn.execute("SELECT COUNT(*) FROM registrations").fetchone()[0] == 0
+            if empty and os.path.exists(REGISTRATIONS_FILE):
+                legacy = load_json(REGISTRATIONS_FILE)
+                with conn:
+                    conn.execute("BEGIN IMMEDIATE")
+                    conn.executemany("INSERT OR IGNORE INTO registrations (discord_id, tag) VALUES (?, ?)",
+                                     [(str(k), str(v)) for k, v in legacy.items()])
+                logger.info(f"Migrados {len(legacy)} registro(s) de {REGISTRATIONS_FILE} para {SHARED_STATE_DB}.")
+        logger.info(f"Armazenamento compartilhado pronto em {SHARED_STATE_DB} (worker: {WORKER_ID}).")
+        return True
+    except sqlite3.Error as e:
+        logger.error(f"Erro ao inicializar armazenamento compartilhado {SHARED_STATE_DB}: {e}")
+        return False
+
+def load_registrations():
+    """Lê todos os registros do banco compartilhado. Retorna None em caso de erro."""
+    try:
+        with closing(_lease_db()) as conn:
+            return dict(conn.execute("SELECT discord_id, tag FROM registrations").fetchall())
+    except sqlite3.Error as e:
+        logger.error(f"Erro ao ler registros de {SHARED_STATE_DB}: {e}")
+        return None
+
+def save_registrations(pairs):
+    """Grava (discord_id, tag) em uma única transação e atualiza o cache em memória."""
+    pairs = [(str(discord_id), tag) for discord_id, tag in pairs]
+    try:
+        with closing(_lease_db()) as conn, conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany("INSERT INTO registrations (discord_id, tag) VALUES (?, ?) "
+                             "ON CONFLICT(discord_id) DO UPDATE SET tag = excluded.tag", pairs)
+    except sqlite3.Error as e:
+        logger.error(f"Erro ao salvar registros em {SHARED_STATE_DB}: {e}")
+        return False
+    registrations.update(pairs)
+    return True
+
+def save_registration(discord_id, tag):
+    return save_registrations([(discord_id, tag)])
+
+def load_sweep_state():
+    """Lê o estado da verificação (discord_id -> [tag, cargo CoC]) do banco. Retorna None em caso de erro."""
+    try:
+        with closing(_lease_db()) as conn:
+            return {d: [tag, role] for d, tag, role in conn.execute("SELECT discord_id, tag, role FROM sweep_state")}
+    except sqlite3.Error as e:
+        logger.error(f"Erro ao ler estado da verificação de {SHARED_STATE_DB}: {e}")
+        return None
+
+def set_sweep_state(discord_id, tag, role):
+    """Guarda o resultado da última verificação bem-sucedida (no banco e no cache em memória)."""
+    sweep_state[discord_id] = [tag, role]
+    try:
+        with closing(_lease_db()) as conn:
+            conn.execute("INSERT INTO sweep_state (discord_id, tag, role) VALUES (?, ?, ?) "
+                         "ON CONFLICT(discord_id) DO UPDATE SET tag = excluded.tag, role = excluded.role", (discord_id, tag, role))
+    except sqlite3.Error as e:
+        logger.error(f"Erro ao salvar estado da verificação de {discord_id}: {e}")
+
+def clear_sweep_state(discord_id):
+    sweep_state.pop(discord_id, None)
+    try:
+        with closing(_lease_db()) as conn:
+            conn.execute("DELETE FROM sweep_state WHERE discord_id = ?", (discord_id,))
+    except sqlite3.Error as e:
+        logger.error(f"Erro ao remover estado da verificação de {discord_id}: {e}")
+
+def delete_registration(discord_id):
+    """Remove o registro de `discord_id` do banco e do cache em memória."""
+    discord_id = str(discord_id)
+    registrations.pop(discord_id, None)
+    try:
+        with closing(_lease_db()) as conn:
+            conn.execute("DELETE FROM registrations WHERE discord_id = ?", (discord_id,))
+        return True
+    except sqlite3.Error as e:
+        logger.error(f"Erro ao remover registro {discord_id} de {SHARED_STATE_DB}: {e}")
+        return False
+
+def _try_acquire_lease(key, ttl):
+    now = time.time()
+    with closing(_lease_db()) as conn:
+        cursor = conn.execute(
+            "INSERT INTO leases (key, owner, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+            "WHERE leases.owner = excluded.owner OR leases.expires_at < ?",
+            (key, WORKER_ID, now + ttl, now)
+        )
+        return cursor.rowcount > 0
+
+def _release_lease(key):
+    with closing(_lease_db()) as conn:
+        conn.execute("DELETE FROM leases WHERE key = ? AND owner = ?", (key, WORKER_ID))
+
+async def acquire_lease(key, ttl=LEASE_TTL):
+    """Adquire (ou renova) o lease `key` para este worker. Retorna True se obtido."""
+    try:
+        return await asyncio.to_thread(_try_acquire_lease, key, ttl)
+    except sqlite3.Error as e:
+        logger.error(f"Erro ao adquirir lease {key}: {e}")
+        # Sem shards não há concorrência entre processos, então seguimos sem o lease
+        return not SHARD_COUNT
+
+async def release_lease(key):
+    """Libera o lease `key` se ele pertencer a este worker."""
+    try:
+        await asyncio.to_thread(_release_lease, key)
+    except sqlite3.Error as e:
+        logger.error(f"Erro ao liberar lease {key}: {e}")
+
+def _purge_expired_leases():
+    with closing(_lease_db()) as conn:
+        conn.execute("DELETE FROM leases WHERE expires_at < ?", (time.time(),))
+
+async def purge_expired_leases():
+    """Remove leases expirados (ex: marcadores de ciclos antigos da verificação)."""
+    try:
+        await asyncio.to_thread(_purge_expired_leases)
+    except sqlite3.Error as e:
+        logger.error(f"Erro ao limpar leases expirados: {e}")
+
+def _lease_active(key):
+    with closing(_lease_db()) as conn:
+        row = conn.execute("SELECT expires_at FROM leases WHERE key = ?", (key,)).fetchone()
+        return bool(row) and row[0] > time.time()
+
+async def is_lease_active(key):
+    """Retorna True se algum worker (inclusive este) detém o lease `key`."""
+    try:
+        return await asyncio.to_thread(_lease_active, key)
+    except sqlite3.Error as e:
+        logger.error(f"Erro ao consultar lease {key}: {e}")
         return False
 
 # --- Inicialização do Cliente CoC ---
@@ -92,13 +347,16 @@ async def initialize_coc_client():
     for attempt in range(1, 4):
         try:
             logger.info(f"[Tentativa {attempt}/3] Criando Client CoC para procurar/usar a chave chamada '{COC_KEY_NAME}'...")
-            temp_client = coc.Client(key_count=1, key_names=COC_KEY_NAME, throttle_limit=20)
+            temp_client = coc.Client(key_count=1, key_names=COC_KEY_NAME, throttle_limit=COC_THROTTLE_LIMIT)
             logger.info(f"[Tentativa {attempt}/3] Tentando login com Email/Senha...")
             await asyncio.wait_for(temp_client.login(EMAIL, PASSWORD), timeout=90.0)
             if hasattr(temp_client, 'http') and temp_client.http:
                  # Atribui à variável global
                  coc_client = temp_client
                  logger.info(f"[Tentativa {attempt}/3] Login CoC e inicialização do Client OK. O bot tentará usar a chave '{COC_KEY_NAME}' se encontrada.")
+                 if deferred_approvals:
+                     # Qualquer login bem-sucedido (boot ou relogin) libera as aprovações enfileiradas
+                     spawn_background(replay_deferred_approvals())
                  return True
             else:
                  logger.error(f"[Tentativa {attempt}/3] Login CoC pareceu OK, mas a sessão HTTP não foi estabelecida corretamente.")
@@ -106,7 +364,7 @@ async def initialize_coc_client():
                      await temp_client.close()
                  except Exception:
                      pass
-        except coc_errors.AuthenticationError as e_auth:
+        except coc_errors.InvalidCredentials as e_auth:
             logger.error(f"[Tentativa {attempt}/3] Falha de autenticação CoC: {e_auth}. Verifique email/senha e 2FA se aplicável.")
             return False
         except asyncio.TimeoutError:
@@ -127,21 +385,322 @@ async def initialize_coc_client():
     coc_client = None
     return False
 
+# --- Tarefas em Background ---
+def spawn_background(coro):
+    """Cria uma tarefa em background mantendo uma referência até ela terminar."""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+# --- Cache de Perfis de Jogadores ---
+def cache_player(player):
+    """Converte um coc.Player em um resumo serializável e guarda no cache."""
+    entry = {
+        "name": player.name,
+        "town_hall": player.town_hall,
+        "exp_level": player.exp_level,
+        "war_stars": player.war_stars,
+        "trophies": player.trophies,
+        "best_trophies": player.best_trophies,
+        "attack_wins": player.attack_wins,
+        "fetched_at": time.time(),
+    }
+    player_cache[player.tag] = entry
+    return entry
+
+def get_cached_player(tag, max_age=PLAYER_CACHE_MAX_AGE):
+    """Retorna o perfil em cache se tiver no máximo `max_age` segundos, senão None."""
+    entry = player_cache.get(tag)
+    if entry and time.time() - entry.get("fetched_at", 0) <= max_age:
+        return entry
+    return None
+
+def format_player_summary(entry):
+    """Formata um perfil do cache em uma linha para mensagens."""
+    summary = (
+        f"CV {entry['town_hall']} · ⭐ {entry['war_stars']} estrelas de guerra · "
+        f"🎖️ Nível {entry['exp_level']} · 🏆 {entry['trophies']} (recorde {entry['best_trophies']})"
+    )
+    age = time.time() - entry.get("fetched_at", 0)
+    if age > PLAYER_CACHE_TTL:
+        summary += f" *(dados de {age / 3600:.0f}h atrás)*"
+    return summary
+
+async def enrich_players(tags, max_age=PLAYER_CACHE_TTL):
+    """Garante perfis com no máximo `max_age` segundos no cache, buscando os que faltam em lotes.
+
+    Os lotes têm o tamanho do throttle do cliente CoC; dentro de cada lote as buscas são concorrentes.
+    Retorna um dicionário tag -> perfil com o que estiver disponível (inclusive em cache).
+    """
+    tags = list(dict.fromkeys(tags))
+    missing = [tag for tag in tags if not get_cached_player(tag, max_age)]
+    if missing and coc_client and getattr(coc_client, 'http', None):
+        fetched = 0
+        for i in range(0, len(missing), COC_THROTTLE_LIMIT):
+            batch = missing[i:i + COC_THROTTLE_LIMIT]
+            try:
+                async def collect():
+                    return [player async for player in coc_client.get_players(batch)]
+                for player in await asyncio.wait_for(collect(), timeout=30.0):
+                    cache_player(player)
+                    fetched += 1
+            except (coc_errors.ClashOfClansException, asyncio.TimeoutError) as e:
+                logger.warning(f"Falha ao buscar lote de {len(batch)} perfis de jogadores ({type(e).__name__}). Usando cache disponível.")
+                break
+        if fetched:
+            # Descarta perfis muito antigos e persiste fora do event loop
+            now = time.time()
+            for tag in [t for t, e in player_cache.items() if now - e.get("fetched_at", 0) > PLAYER_CACHE_MAX_AGE]:
+                del player_cache[tag]
+            await asyncio.to_thread(save_json, dict(player_cache), PLAYER_CACHE_FILE)
+            logger.info(f"Cache de jogadores atualizado: {fetched}/{len(missing)} perfis buscados.")
+    return {tag: player_cache[tag] for tag in tags if get_cached_player(tag)}
+
+# --- Agregados de Atividade (doações/troféus) ---
+# Cada jogador guarda um anel de ACTIVITY_DAYS "baldes" diários com o quanto cada campo
+# variou naquele dia. Cada roster obtido por get_clan é dobrado nesses baldes em O(membros),
+# sem chamadas extras à API, e os rankings de /atividade são recalculados na hora.
+def _activity_today():
+    return datetime.now(TIMEZONE).date().toordinal()
+
+def _new_activity_record():
+    field_count = len(ACTIVITY_FIELDS)
+    return {
+        "name": "",
+        "since": _activity_today(), # Dia (ordinal) da primeira leitura; antes disso não há base de comparação
+        "last": None, # Últimos valores brutos vistos (array) ou None
+        "days": array('l', [0] * ACTIVITY_DAYS), # Dia (ordinal) a que cada balde pertence
+        "buckets": array('l', [0] * (ACTIVITY_DAYS * field_count)),
+    }
+
+def load_activity():
+    """Carrega os agregados de ACTIVITY_FILE para os arrays em memória."""
+    global activity
+    activity = {}
+    for tag, data in load_json(ACTIVITY_FILE).items():
+        record = _new_activity_record()
+        record["name"] = data.get("name", "")
+        record["last"] = array('l', data["last"]) if data.get("last") else None
+        if len(data.get("days", [])) == ACTIVITY_DAYS:
+            record["days"] = array('l', data["days"])
+            record["buckets"] = array('l', data["buckets"])
+        # Arquivos antigos não têm "since": o balde mais antigo em uso é o melhor palpite
+        seen_days = [d for d in record["days"] if d]
+        record["since"] = data.get("since") or (min(seen_days) if seen_days else record["since"])
+        activity[tag] = record
+    rebuild_activity_rankings()
+
+async def save_activity():
+    """Persiste os agregados em ACTIVITY_FILE fora do event loop."""
+    data = {
+        tag: {"name": r["name"], "since": r["since"], "last": list(r["last"]) if r["last"] else None, "days": list(r["days"]), "buckets": list(r["buckets"])}
+        for tag, r in activity.items()
+    }
+    async with activity_save_lock:
+        await asyncio.to_thread(save_json, data, ACTIVITY_FILE)
+
+def activity_totals(record, days, today):
+    """Soma os baldes dos últimos `days` dias (incluindo hoje), por campo."""
+    field_count = len(ACTIVITY_FIELDS)
+    totals = [0] * field_count
+    for slot in range(ACTIVITY_DAYS):
+        if today - days < record["days"][slot] <= today:
+            for f in range(field_count):
+                totals[f] += record["buckets"][slot * field_count + f]
+    return totals
+
+def fold_roster(clan):
+    """Incorpora um roster (coc.Clan) nos agregados de atividade e recalcula os rankings."""
+    if not clan or not clan.members:
+        return
+    today = _activity_today()
+    slot = today % ACTIVITY_DAYS
+    field_count = len(ACTIVITY_FIELDS)
+    current_tags = set()
+    for member in clan.members:
+        current_tags.add(member.tag)
+        record = activity.get(member.tag)
+        if record is None:
+            record = activity[member.tag] = _new_activity_record()
+        if record["days"][slot] != today:
+            # Balde de um dia que saiu da janela: reaproveita
+            record["days"][slot] = today
+            for f in range(field_count):
+                record["buckets"][slot * field_count + f] = 0
+        raw = array('l', (member.donations, member.received, member.trophies))
+        if record["last"] is not None:
+            # Doações zeram no início da temporada, quando os troféus também são rebaixados
+            season_reset = raw[0] < record["last"][0] or raw[1] < record["last"][1]
+            for f, field in enumerate(ACTIVITY_FIELDS):
+                delta = raw[f] - record["last"][f]
+                if season_reset:
+                    # Doações: tudo desde o reset é novo. Troféus: a queda do reset não é atividade
+                    delta = 0 if field == "trophies" else (raw[f] if delta < 0 else delta)
+                record["buckets"][slot * field_count + f] += delta
+        record["last"] = raw
+        record["name"] = member.name
+    for tag in [t for t in activity if t not in current_tags]:
+        # Saiu do clã
+        del activity[tag]
+    rebuild_activity_rankings()
+    if activity_save_lock:
+        spawn_background(save_activity())
+
+def record_roster(clan):
+    """Ponto único para todo roster obtido por get_clan: atualiza agregados e o snapshot de warm-start."""
+    if not clan:
+        return
+    fold_roster(clan)
+    roster_snapshot.update({
+        "clan_tag": clan.tag,
+        "name": clan.name,
+        "fetched_at": time.time(),
+        "members": {m.tag: {"name": m.name, "role": m.role.in_game_name.lower()} for m in clan.members},
+    })
+
+def rebuild_activity_rankings():
+    """Pré-calcula os rankings (menos ativos primeiro) servidos pelo /atividade."""
+    global activity_rankings
+    today = _activity_today()
+    computed_at = datetime.now(TIMEZONE).strftime('%d/%m %H:%M')
+    rankings = {}
+    for period, days in (("diario", 1), ("semanal", ACTIVITY_DAYS)):
+        rows = []
+        new_players = 0
+        for tag, record in activity.items():
+            if record["since"] > today - days:
+                # Acompanhado há menos tempo que o período: parecer "inativo" seria só falta de dados
+                new_players += 1
+                continue
+            donations, received, trophies = activity_totals(record, days, today)
+            rows.append((donations, received, trophies, record["name"], tag))
+        # Troféus ficam fora da ordenação: variam com ataques/defesas, não com participação
+        rows.sort(key=lambda row: (row[0], row[1]))
+        lines = [f"📉 **Atividade {'de hoje' if days == 1 else f'dos últimos {days} dias'}** (menos ativos primeiro, atualizado {computed_at})"]
+        for pos, (donations, received, trophies, name, tag) in enumerate(rows[:ACTIVITY_RANKING_SIZE], start=1):
+            lines.append(f"{pos}. `{name}` (`{tag}`): 🎁 {donations} doadas · 📥 {received} recebidas · 🏆 {trophies:+d}")
+        if not rows:
+            lines.append("*(ainda sem dados - aguarde a próxima verificação do clã)*")
+        if new_players:
+            # Logo abaixo do título, para não ser cortado pelo limite de caracteres
+            lines.insert(1, f"*{new_players} jogador(es) acompanhado(s) há menos tempo que o período ficaram de fora.*")
+        rankings[period] = "\n".join(lines)[:DISCORD_MESSAGE_LIMIT]
+    activity_rankings = rankings
+
+# --- Snapshot de Warm-Start ---
+# Roster, resumo dos cargos e estado da verificação são salvos em disco periodicamente e ao
+# desligar. No boot, consultas somente-leitura usam esse snapshot (marcado como desatualizado)
+# enquanto o login no CoC não termina, e alterações ficam na fila até os dados ao vivo chegarem.
+def snapshot_roster():
+    """Retorna o roster salvo se for do clã configurado, senão None."""
+    if roster_snapshot.get("members") is not None and roster_snapshot.get("clan_tag") == config.get("clan_tag"):
+        return roster_snapshot
+    return None
+
+def stale_note():
+    """Aviso padrão para respostas baseadas no snapshot."""
+    fetched_at = datetime.fromtimestamp(roster_snapshot.get("fetched_at", 0), TIMEZONE).strftime('%d/%m %H:%M')
+    return f"🕒 *Dados salvos de {fetched_at} (podem estar desatualizados).*"
+
+def build_role_summary():
+    """Resolve o mapeamento cargo CoC -> cargo Discord (ID e nome) para o snapshot."""
+    guild = get_registration_guild()
+    summary = {}
+    for coc_role, role_id in config.get("roles", {}).items():
+        role = guild.get_role(role_id) if guild and role_id else None
+        known = role_summary.get(coc_role) or {}
+        # Sem o servidor em cache, mantém o nome já conhecido para o mesmo cargo
+        name = role.name if role else (known.get("name") if known.get("id") == role_id else None)
+        summary[coc_role] = {"id": role_id, "name": name}
+    return summary
+
+def describe_role(guild, coc_role):
+    """Menção do cargo Discord mapeado a `coc_role`; com o cache frio, usa o nome salvo no snapshot."""
+    role_id = config.get("roles", {}).get(coc_role)
+    role = guild.get_role(role_id) if guild and role_id else None
+    if role:
+        return role.mention
+    known = role_summary.get(coc_role) or {}
+    if role_id and known.get("id") == role_id and known.get("name"):
+        return f"**@{known['name']}**"
+    return "*(não configurado)*"
+
+def build_warm_snapshot():
+    """Monta (com cópias) o conteúdo de WARM_SNAPSHOT_FILE: roster, resumo de cargos e estado da verificação."""
+    return {
+        "saved_at": time.time(),
+        "roster": dict(roster_snapshot),
+        "role_summary": build_role_summary(),
+        "sweep": {"last_run_at": last_sweep_at}, # Estado por membro fica em SHARED_STATE_DB
+    }
+
+def load_warm_snapshot():
+    """Carrega o snapshot salvo para as globais de warm-start."""
+    global roster_snapshot, sweep_state, last_sweep_at, role_summary
+    data = load_json(WARM_SNAPSHOT_FILE)
+    role_summary = data.get("role_summary") or {}
+    roster_snapshot = data.get("roster") or {}
+    # Snapshots antigos traziam o estado por membro; init_shared_store o migra para o banco
+    sweep_state = data.get("sweep", {}).get("members") or {}
+    last_sweep_at = data.get("sweep", {}).get("last_run_at")
+    if roster_snapshot:
+        logger.info(f"Snapshot de warm-start carregado: {len(roster_snapshot.get('members', {}))} membros do clã, {len(sweep_state)} membros verificados.")
+
+@tasks.loop(minutes=SNAPSHOT_INTERVAL_MINUTES)
+async def snapshot_task():
+    """Salva o snapshot de warm-start periodicamente."""
+    if roster_snapshot or sweep_state:
+        await asyncio.to_thread(save_json, build_warm_snapshot(), WARM_SNAPSHOT_FILE)
+
 # --- Bot Discord ---
 intents = discord.Intents.default()
 intents.members = True
 intents.message_content = True
-bot = commands.Bot(command_prefix="!", intents=intents, help_command=None)
+if SHARD_COUNT:
+    # Cada processo conecta apenas os shards em SHARD_IDS (ou todos, se vazio)
+    bot = commands.AutoShardedBot(command_prefix="!", intents=intents, help_command=None, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS)
+else:
+    bot = commands.Bot(command_prefix="!", intents=intents, help_command=None)
+
+def get_registration_guild():
+    """Retorna o servidor do canal de registro, se estiver nos shards deste processo."""
+    reg_channel = bot.get_channel(config.get("registration_channel_id")) if config.get("registration_channel_id") else None
+    if reg_channel:
+        return reg_channel.guild
+    # Sem shards existe um único processo, então o primeiro servidor é o alvo
+    if not SHARD_COUNT and bot.guilds:
+        return bot.guilds[0]
+    return None
+
+async def fetch_registration_guild():
+    """Busca o servidor de registro via REST, para workers que não conectam o shard dele.
+
+    Membros e canais são adicionados ao próprio objeto, então get_member/get_channel/me
+    funcionam como no servidor em cache.
+    """
+    guild_id = config.get("guild_id")
+    if not guild_id:
+        return None
+    guild = await bot.fetch_guild(guild_id)
+    async for member in guild.fetch_members(limit=None):
+        guild._add_member(member)
+    for channel in await guild.fetch_channels():
+        guild._add_channel(channel)
+    logger.info(f"Servidor {guild.name} buscado via REST ({guild.member_count or len(guild.members)} membros).")
+    return guild
 
 # --- Evento On Ready ---
 @bot.event
 async def on_ready():
     """Executado quando o bot está online e pronto."""
     # Declaração global no início
-    global config, registrations, coc_client #, pending_approvals # Opcional
+    global config, registrations, coc_client, player_cache, war_log_state, activity_save_lock, registration_queue #, pending_approvals # Opcional
     logger.info(f"Bot {bot.user.name} ({bot.user.id}) conectado ao Discord!")
     logger.info(f"Usando discord.py v{discord.__version__}")
     logger.info(f"Executando em {len(bot.guilds)} servidor(es).")
+    if SHARD_COUNT:
+        logger.info(f"Worker {WORKER_ID}: shards {SHARD_IDS or 'todos'} de {SHARD_COUNT}.")
     if bot.guilds:
         logger.info(f"Servidor exemplo: {bot.guilds[0].name} ({bot.guilds[0].id})")
     else:
@@ -149,17 +708,29 @@ async def on_ready():
 
     # Lê as configurações e registros
     config = load_json(CONFIG_FILE)
-    registrations = load_json(REGISTRATIONS_FILE)
+    init_shared_store()
+    registrations = load_registrations() or {}
+    player_cache = load_json(PLAYER_CACHE_FILE)
+    war_log_state = load_json(WAR_LOG_STATE_FILE)
+    load_activity()
+    activity_save_lock = asyncio.Lock()
+    if registration_queue is None:
+        registration_queue = asyncio.Queue(maxsize=ADMISSION_QUEUE_MAX)
+        spawn_background(registration_admission_worker())
+        logger.info("Fila de admissão do /registrar iniciada.")
     # pending_approvals = load_json(PENDING_APPROVALS_FILE) # Opcional
     logger.info(f"Configurações carregadas ({len(config)} itens).")
     logger.info(f"Registros carregados ({len(registrations)} usuários).")
+    logger.info(f"Cache de jogadores carregado ({len(player_cache)} perfis).")
     # logger.info(f"Aprovações pendentes carregadas ({len(pending_approvals)}).") # Opcional
 
-    try:
-        synced = await bot.tree.sync()
-        logger.info(f"Sincronizados {len(synced)} comandos slash.")
-    except Exception as e:
-        logger.error(f"Falha ao sincronizar comandos slash: {e}")
+    # Com vários workers, apenas o dono do shard 0 sincroniza os comandos slash
+    if not SHARD_IDS or 0 in SHARD_IDS:
+        try:
+            synced = await bot.tree.sync()
+            logger.info(f"Sincronizados {len(synced)} comandos slash.")
+        except Exception as e:
+            logger.error(f"Falha ao sincronizar comandos slash: {e}")
 
     # Inicializa o cliente CoC (que usa a global coc_client)
     if not await initialize_coc_client():
@@ -172,6 +743,14 @@ async def on_ready():
             logger.info("Tarefa de verificação periódica iniciada.")
         else:
              logger.warning("Tarefa de verificação periódica já estava rodando.")
+        if not war_log_task.is_running():
+            war_log_task.start()
+            logger.info("Tarefa de log de guerras iniciada.")
+
+    if not snapshot_task.is_running():
+        snapshot_task.start()
+    if not deferred_approval_task.is_running():
+        deferred_approval_task.start()
 
     logger.info("Bot pronto!")
 
@@ -186,7 +765,8 @@ async def on_ready():
     member_role="Cargo para Membros do clã.",
     elder_role="Cargo para Anciãos do clã.",
     coleader_role="Cargo para Co-Líderes do clã.",
-    kick_message="Mensagem a ser enviada ao membro ao ser expulso (opcional)."
+    kick_message="Mensagem a ser enviada ao membro ao ser expulso (opcional).",
+    war_log_channel="Canal onde ataques de guerra e resultados de guerras/raids serão postados (opcional)."
 )
 async def setup_command(
     interaction: discord.Interaction,
@@ -197,7 +777,8 @@ async def setup_command(
     member_role: discord.Role,
     elder_role: discord.Role,
     coleader_role: discord.Role,
-    kick_message: str = "Você foi removido do servidor por não fazer mais parte do clã."
+    kick_message: str = "Você foi removido do servidor por não fazer mais parte do clã.",
+    war_log_channel: discord.TextChannel = None
 ):
     """Comando para configurar as definições essenciais do bot."""
     # Declaração global no início
@@ -224,6 +805,8 @@ async def setup_command(
         "Logs": log_channel,
         "Aprovações": approval_log_channel
     }
+    if war_log_channel:
+        channels_to_check["Log de Guerras"] = war_log_channel
     missing_perms = []
     for name, channel in channels_to_check.items():
         perms = channel.permissions_for(bot_member)
@@ -251,6 +834,7 @@ async def setup_command(
 
     new_config = {
         "clan_tag": corrected_clan_tag,
+        "guild_id": interaction.guild.id,
         "registration_channel_id": registration_channel.id,
         "log_channel_id": log_channel.id,
         "approval_log_channel_id": approval_log_channel.id,
@@ -261,7 +845,8 @@ async def setup_command(
             "coleader": coleader_role.id,
             "leader": coleader_role.id
         },
-        "kick_message": kick_message or "Você foi removido do servidor por não fazer mais parte do clã."
+        "kick_message": kick_message or "Você foi removido do servidor por não fazer mais parte do clã.",
+        "war_log_channel_id": war_log_channel.id if war_log_channel else None
     }
 
     if save_json(new_config, CONFIG_FILE):
@@ -277,7 +862,8 @@ async def setup_command(
             f" - **Cargo Membro:** {member_role.mention}\n"
             f" - **Cargo Ancião:** {elder_role.mention} (Usado para 'admin' e 'elder' do CoC)\n"
             f" - **Cargo Colíder:** {coleader_role.mention} (Usado para 'coLeader' e 'leader' do CoC)\n"
-            f" - **Msg Expulsão:** {'`' + config['kick_message'] + '`' if config['kick_message'] else '*(Padrão)*'}"
+            f" - **Msg Expulsão:** {'`' + config['kick_message'] + '`' if config['kick_message'] else '*(Padrão)*'}\n"
+            f" - **Canal Log de Guerras:** {war_log_channel.mention if war_log_channel else '*(Desativado)*'}"
         )
         await interaction.followup.send(confirmation_message, ephemeral=True)
 
@@ -293,6 +879,181 @@ async def setup_command(
         await interaction.followup.send("❌ Falha grave ao salvar o arquivo de configuração no disco.", ephemeral=True)
 
 
+# --- Fila de Admissão do /registrar ---
+# O /registrar só faz validações locais e enfileira; um único worker valida os pedidos
+# em lotes contra um roster compartilhado e posta as solicitações agrupadas no canal de aprovação.
+def take_admission_budget():
+    """Consome uma busca de roster do orçamento por minuto da fila de admissão. False se esgotado."""
+    now = time.monotonic()
+    while admission_budget and now - admission_budget[0] > 60:
+        admission_budget.popleft()
+    if len(admission_budget) >= ADMISSION_ROSTER_BUDGET_PER_MIN:
+        return False
+    admission_budget.append(now)
+    return True
+
+async def get_admission_roster():
+    """Retorna (clan, motivo). Reaproveita o roster recente; clan é None se for preciso esperar."""
+    if admission_roster["clan"] and time.monotonic() - admission_roster["fetched_at"] <= ADMISSION_ROSTER_MAX_AGE:
+        return admission_roster["clan"], None
+    if not coc_client or not hasattr(coc_client, 'http') or not coc_client.http:
+        return None, "a conexão com o Clash of Clans ainda está sendo estabelecida"
+    if not take_admission_budget():
+        return None, "o limite de consultas à API do Clash of Clans foi atingido"
+    clan = await asyncio.wait_for(coc_client.get_clan(config["clan_tag"]), timeout=30.0)
+    try:
+        record_roster(clan)
+    except Exception as e:
+        # Os agregados são secundários; o roster continua válido para a admissão
+        logger.error(f"Erro ao registrar roster na fila de admissão: {e}", exc_info=True)
+    admission_roster["clan"] = clan
+    admission_roster["fetched_at"] = time.monotonic()
+    return clan, None
+
+def find_tag_owner(tag, discord_id_str):
+    """Retorna o ID de outro usuário já registrado com `tag`, ou None."""
+    for reg_id, reg_tag in registrations.items():
+        if reg_tag == tag and reg_id != discord_id_str:
+            return reg_id
+    return None
+
+async def notify_admission(request, message):
+    """Envia o resultado ao usuário pelo followup da interação original."""
+    try:
+        await request["interaction"].followup.send(message, ephemeral=True)
+    except Exception as e:
+        logger.warning(f"Falha ao notificar {request['user']} sobre a solicitação {request['tag']}: {e}")
+
+async def process_registration_batch(batch, clan):
+    """Valida um lote de pedidos contra um único roster e posta as aprovações agrupadas."""
+    log_channel = bot.get_channel(config.get("log_channel_id")) if config.get("log_channel_id") else None
+    approval_log_channel_id = config.get("approval_log_channel_id")
+    approval_log_channel = bot.get_channel(approval_log_channel_id)
+    if not approval_log_channel:
+        logger.error(f"Canal de aprovação configurado (ID: {approval_log_channel_id}) não encontrado.")
+        for request in batch:
+            admission_recent.pop(request["key"], None)
+            await notify_admission(request, "❌ Erro crítico: O canal configurado para aprovações não foi encontrado. Contate um admin.")
+        if log_channel:
+            try: await log_channel.send(f"🆘 **Erro Crítico:** Canal de aprovação ID `{approval_log_channel_id}` não encontrado ao processar {len(batch)} registro(s).")
+            except Exception: pass
+        return
+
+    accepted = []
+    log_lines = []
+    for request in batch:
+        user, tag = request["user"], request["tag"]
+        other_user_id = find_tag_owner(tag, str(user.id))
+        if other_user_id:
+            admission_recent.pop(request["key"], None)
+            await notify_admission(request, f"❌ A tag `{tag}` já está registrada por outro usuário (<@{other_user_id}>). Se isso for um erro, contate um administrador.")
+            continue
+        member_data = clan.get_member(tag)
+        if not member_data:
+            logger.info(f"Tag {tag} NÃO encontrada no clã {clan.name} ({config['clan_tag']}) para {user}.")
+            admission_recent.pop(request["key"], None)
+            await notify_admission(request, f"❌ Jogador com a tag `{tag}` não encontrado no clã **{clan.name}** (`{config['clan_tag']}`).\nVerifique se a tag está correta e se você realmente faz parte deste clã.")
+            log_lines.append(f"⚠️ Falha na solicitação de registro de {user.mention}: Tag `{tag}` não encontrada no clã `{config['clan_tag']}`.")
+            continue
+        logger.info(f"Tag {tag} encontrada no clã {clan.name}. Jogador: {member_data.name}, Cargo CoC: {member_data.role.in_game_name}")
+        accepted.append((request, member_data))
+
+    if accepted:
+        # Perfis do lote numa única rodada; se a API demorar, usa o que houver em cache
+        tags = [request["tag"] for request, _ in accepted]
+        try:
+            profiles = await asyncio.wait_for(enrich_players(tags), timeout=ADMISSION_PROFILE_TIMEOUT)
+        except asyncio.TimeoutError:
+            profiles = {tag: entry for tag in tags if (entry := get_cached_player(tag))}
+
+        blocks = []
+        for request, member_data in accepted:
+            user, tag = request["user"], request["tag"]
+            role_name_display = member_data.role.in_game_name.replace("coLeader", "Co-Líder").capitalize()
+            profile = profiles.get(tag)
+            blocks.append(
+                f"📝 **Solicitação de Registro Pendente**\n"
+                f"👤 **Usuário Discord:** {user.mention} (`{user.id}`)\n"
+                f"🏷️ **Tag CoC:** `{tag}`\n"
+                f"🔖 **Nome no Jogo:** `{member_data.name}`\n"
+                f"👑 **Cargo no Clã:** {role_name_display}\n"
+                f"📊 **Perfil:** {format_player_summary(profile) if profile else '*(perfil indisponível no momento)*'}\n"
+                f"▶️ **Para aprovar:** Use `/aprovar usuario: {user.mention} player_tag: {tag}`\n"
+                f"❌ **Para negar:** Use `/negar usuario: {user.mention} player_tag: {tag} motivo: [Opcional]`\n"
+            )
+        sent = await send_in_batches(approval_log_channel, blocks)
+        logger.info(f"{sent}/{len(blocks)} solicitação(ões) de registro enviadas para o canal {approval_log_channel.name}.")
+        for i, (request, member_data) in enumerate(accepted):
+            if i < sent:
+                await notify_admission(request, f"✅ Sua solicitação de registro para a tag `{request['tag']}` (`{member_data.name}`) foi enviada para aprovação administrativa. Você será notificado se for aprovado ou negado.")
+            else:
+                admission_recent.pop(request["key"], None)
+                await notify_admission(request, f"❌ Erro ao enviar sua solicitação para o canal {approval_log_channel.mention}. Verifique as permissões do bot ou contate um admin.")
+
+    if log_lines and log_channel:
+        await send_in_batches(log_channel, log_lines)
+
+async def registration_admission_worker():
+    """Consome a fila de admissão: espera a janela de agrupamento, busca o roster e processa em lotes."""
+    global coc_client
+    pending = []
+    while True:
+        try:
+            if not pending:
+                pending.append(await registration_queue.get())
+                await asyncio.sleep(ADMISSION_BATCH_WINDOW)
+            # Só puxa o que cabe: durante uma queda do CoC a fila enche e o /registrar passa a recusar (QueueFull)
+            while len(pending) < ADMISSION_QUEUE_MAX and not registration_queue.empty():
+                pending.append(registration_queue.get_nowait())
+
+            # Tokens de interação expiram em 15 minutos; avisa antes disso
+            expired = [r for r in pending if time.monotonic() - r["queued_at"] > ADMISSION_MAX_WAIT]
+            for request in expired:
+                pending.remove(request)
+                admission_recent.pop(request["key"], None)
+                await notify_admission(request, "⌛ Sua solicitação ficou tempo demais na fila. Por favor, use `/registrar` novamente.")
+            if not pending:
+                continue
+
+            try:
+                clan, wait_reason = await get_admission_roster()
+            except coc_errors.NotFound:
+                logger.error(f"Clã {config.get('clan_tag', 'N/A')} não encontrado pela API CoC durante a fila de registro.")
+                for request in pending:
+                    admission_recent.pop(request["key"], None)
+                    await notify_admission(request, f"❌ Erro: Não consegui encontrar o clã `{config.get('clan_tag', 'N/A')}` configurado no bot. Peça a um admin para verificar a tag no `/setup`.")
+                pending = []
+                continue
+            except coc_errors.InvalidCredentials:
+                logger.critical("Erro de autenticação CoC durante a fila de registro. Tentando relogar...")
+                coc_client = None
+                await initialize_coc_client() # Tenta reinicializar o cliente global
+                clan, wait_reason = None, "a conexão com o Clash of Clans está sendo restabelecida"
+            except (coc_errors.ClashOfClansException, asyncio.TimeoutError) as e:
+                logger.warning(f"Falha ao buscar roster para a fila de registro ({type(e).__name__}: {e}). Tentando novamente.")
+                clan, wait_reason = None, "a API do Clash of Clans está instável"
+
+            if clan is None:
+                for request in pending:
+                    if not request["queued_notified"]:
+                        request["queued_notified"] = True
+                        await notify_admission(request, f"⏳ Sua solicitação está na fila porque {wait_reason}. Você será avisado aqui assim que ela for processada.")
+                await asyncio.sleep(ADMISSION_RETRY_DELAY)
+                continue
+
+            batch, pending = pending[:ADMISSION_BATCH_MAX], pending[ADMISSION_BATCH_MAX:]
+            try:
+                await process_registration_batch(batch, clan)
+            except Exception as e:
+                logger.error(f"Erro inesperado ao processar lote de {len(batch)} registro(s): {e}", exc_info=True)
+                for request in batch:
+                    admission_recent.pop(request["key"], None)
+                    await notify_admission(request, "❌ Ocorreu um erro inesperado durante a solicitação. Contate um admin.")
+        except Exception as e:
+            # Nada deve derrubar o worker: os pedidos pendentes continuam na fila para a próxima passada
+            logger.error(f"Erro inesperado na fila de admissão ({len(pending)} pedido(s) pendentes): {e}", exc_info=True)
+            await asyncio.sleep(ADMISSION_RETRY_DELAY)
+
 # --- Comando /registrar ---
 @bot.tree.command(name="registrar", description="Solicita o registro no clã com sua tag do Clash of Clans.")
 @discord.app_commands.describe(player_tag="Sua tag de jogador no Clash of Clans (ex: #XYZABCD).")
@@ -300,17 +1061,14 @@ async def register_command(
     interaction: discord.Interaction,
     player_tag: str
 ):
-    """Solicita o registro de um membro para aprovação administrativa."""
-    # Declaração global no início
-    global coc_client
+    """Valida localmente e coloca a solicitação na fila de admissão para aprovação administrativa."""
     await interaction.response.defer(ephemeral=True)
 
     if not config or "clan_tag" not in config or not config.get("roles") or not config.get("approval_log_channel_id"):
         await interaction.followup.send("❌ O bot ainda não foi completamente configurado (falta definir clã, cargos ou canal de aprovação). Peça a um admin para usar `/setup`.", ephemeral=True)
         return
-    # Usa a global coc_client (declarada acima)
-    if not coc_client or not hasattr(coc_client, 'http') or not coc_client.http:
-        await interaction.followup.send("⏳ A conexão com o Clash of Clans ainda está sendo estabelecida ou falhou. Tente novamente em um minuto ou contate um admin.", ephemeral=True)
+    if registration_queue is None:
+        await interaction.followup.send("⏳ O bot ainda está iniciando. Tente novamente em alguns segundos.", ephemeral=True)
         return
 
     reg_channel_id = config.get("registration_channel_id")
@@ -339,93 +1097,42 @@ async def register_command(
         else:
              logger.warning(f"Usuário {interaction.user} ({discord_id_str}), já registrado com {registrations[discord_id_str]}, tentando registrar nova tag {corrected_tag}.")
 
-    tag_already_registered_by_other = False
-    other_user_id = None
-    for reg_id, reg_tag in registrations.items():
-        if reg_tag == corrected_tag and reg_id != discord_id_str:
-            tag_already_registered_by_other = True
-            other_user_id = reg_id
-            break
-
-    if tag_already_registered_by_other:
+    other_user_id = find_tag_owner(corrected_tag, discord_id_str)
+    if other_user_id:
         other_user = interaction.guild.get_member(int(other_user_id))
         other_user_mention = f"<@{other_user_id}>" if not other_user else other_user.mention
         logger.warning(f"Tentativa de registro da tag {corrected_tag} por {interaction.user}, mas já registrada para {other_user_mention} ({other_user_id}).")
         await interaction.followup.send(f"❌ A tag `{corrected_tag}` já está registrada por outro usuário ({other_user_mention}). Se isso for um erro, contate um administrador.", ephemeral=True)
         return
 
-    log_channel = bot.get_channel(config.get("log_channel_id")) if config.get("log_channel_id") else None
-    approval_log_channel_id = config.get("approval_log_channel_id")
-    approval_log_channel = bot.get_channel(approval_log_channel_id)
-    if not approval_log_channel:
-         logger.error(f"Canal de aprovação configurado (ID: {approval_log_channel_id}) não encontrado.")
-         await interaction.followup.send("❌ Erro crítico: O canal configurado para aprovações não foi encontrado. Contate um admin.", ephemeral=True)
-         if log_channel:
-             try: await log_channel.send(f"🆘 **Erro Crítico:** Canal de aprovação ID `{approval_log_channel_id}` não encontrado ao processar registro de {interaction.user.mention}.")
-             except Exception: pass
-         return
+    # Deduplicação: o mesmo (usuário, tag) dentro da janela não gera outra solicitação
+    now = time.monotonic()
+    for key in [k for k, t in admission_recent.items() if now - t > ADMISSION_DEDUPE_WINDOW]:
+        del admission_recent[key]
+    key = (discord_id_str, corrected_tag)
+    if key in admission_recent:
+        logger.info(f"Solicitação duplicada de {interaction.user} para {corrected_tag} ignorada.")
+        await interaction.followup.send(f"ℹ️ Já recebemos sua solicitação para a tag `{corrected_tag}`. Aguarde a análise de um administrador.", ephemeral=True)
+        return
 
+    request = {"key": key, "interaction": interaction, "user": interaction.user, "tag": corrected_tag, "queued_at": now, "queued_notified": False}
     try:
-        logger.info(f"Usuário {interaction.user} ({interaction.user.id}) solicitando registro com tag {corrected_tag}")
-        # Usa a global coc_client (declarada no início da função)
-        clan = await asyncio.wait_for(coc_client.get_clan(config["clan_tag"]), timeout=30.0)
-        member_data = clan.get_member(corrected_tag)
-
-        if member_data:
-            player_name = member_data.name
-            player_role_coc = member_data.role.in_game_name
-            logger.info(f"Tag {corrected_tag} encontrada no clã {clan.name}. Jogador: {player_name}, Cargo CoC: {player_role_coc}")
-
-            role_name_display = player_role_coc.replace("coLeader", "Co-Líder").capitalize()
-
-            approval_message = (
-                f"📝 **Solicitação de Registro Pendente**\n\n"
-                f"👤 **Usuário Discord:** {interaction.user.mention} (`{interaction.user.id}`)\n"
-                f"🏷️ **Tag CoC:** `{corrected_tag}`\n"
-                f"🔖 **Nome no Jogo:** `{player_name}`\n"
-                f"👑 **Cargo no Clã:** {role_name_display}\n\n"
-                f"▶️ **Para aprovar:** Use `/aprovar usuario: {interaction.user.mention} player_tag: {corrected_tag}`\n"
-                f"❌ **Para negar:** Use `/negar usuario: {interaction.user.mention} player_tag: {corrected_tag} motivo: [Opcional]`"
-            )
-            try:
-                await approval_log_channel.send(approval_message)
-                logger.info(f"Solicitação de registro para {interaction.user} ({corrected_tag}) enviada para o canal {approval_log_channel.name}")
-                await interaction.followup.send(f"✅ Sua solicitação de registro para a tag `{corrected_tag}` (`{player_name}`) foi enviada para aprovação administrativa. Você será notificado se for aprovado ou negado.", ephemeral=True)
-
-            except discord.Forbidden:
-                logger.error(f"Sem permissão para enviar mensagem no canal de aprovação {approval_log_channel.mention}")
-                await interaction.followup.send(f"❌ Erro ao enviar sua solicitação para o canal {approval_log_channel.mention}. Verifique as permissões do bot ou contate um admin.", ephemeral=True)
-            except Exception as e:
-                logger.error(f"Erro ao enviar para canal de aprovação: {e}", exc_info=True)
-                await interaction.followup.send("❌ Ocorreu um erro interno ao enviar sua solicitação para aprovação.", ephemeral=True)
-
-        else:
-            logger.info(f"Tag {corrected_tag} NÃO encontrada no clã {clan.name} ({config['clan_tag']}) para {interaction.user}.")
-            await interaction.followup.send(f"❌ Jogador com a tag `{corrected_tag}` não encontrado no clã **{clan.name}** (`{config['clan_tag']}`).\nVerifique se a tag está correta e se você realmente faz parte deste clã.", ephemeral=True)
-            if log_channel:
-                 try:
-                    await log_channel.send(f"⚠️ Falha na solicitação de registro de {interaction.user.mention}: Tag `{corrected_tag}` não encontrada no clã `{config['clan_tag']}`.")
-                 except Exception as e:
-                     logger.error(f"Falha ao enviar log de registro (não encontrado) para canal: {e}")
-
-    except coc_errors.NotFound:
-        logger.error(f"Clã {config.get('clan_tag', 'N/A')} não encontrado pela API CoC durante solicitação de registro.")
-        await interaction.followup.send(f"❌ Erro: Não consegui encontrar o clã `{config.get('clan_tag', 'N/A')}` configurado no bot. Peça a um admin para verificar a tag no `/setup`.", ephemeral=True)
-    except coc_errors.AuthenticationError:
-        logger.critical("Erro de autenticação CoC durante comando /registrar. Tentando relogar...")
-        # Usa a global coc_client (declarada no início da função)
-        coc_client = None
-        await initialize_coc_client() # Tenta reinicializar o cliente global
-        await interaction.followup.send("❌ Ocorreu um problema temporário de conexão com a API do Clash of Clans. Por favor, tente registrar novamente em um instante.", ephemeral=True)
-    except coc_errors.ClashOfClansException as e_coc:
-        logger.error(f"Erro da API CoC ({type(e_coc).__name__}) ao solicitar registro {corrected_tag}: {e_coc}")
-        await interaction.followup.send(f"❌ Ocorreu um erro ao comunicar com a API do Clash of Clans ({type(e_coc).__name__}). Tente novamente mais tarde.", ephemeral=True)
-    except asyncio.TimeoutError:
-        logger.warning(f"Timeout ao buscar clã/jogador ({corrected_tag}) para solicitação de registro.")
-        await interaction.followup.send("❌ A API do Clash of Clans demorou muito para responder. Tente novamente.", ephemeral=True)
-    except Exception as e:
-        logger.error(f"Erro inesperado no comando /registrar para {corrected_tag}: {e}", exc_info=True)
-        await interaction.followup.send("❌ Ocorreu um erro inesperado durante a solicitação. Contate um admin.", ephemeral=True)
+        registration_queue.put_nowait(request)
+    except asyncio.QueueFull:
+        logger.warning(f"Fila de registro cheia; solicitação de {interaction.user} ({corrected_tag}) recusada.")
+        await interaction.followup.send("⏳ Muitas solicitações no momento. Tente novamente em alguns minutos.", ephemeral=True)
+        return
+    admission_recent[key] = now
+    logger.info(f"Usuário {interaction.user} ({interaction.user.id}) solicitando registro com tag {corrected_tag} (posição {registration_queue.qsize()} na fila)")
+    ack = f"📥 Solicitação para a tag `{corrected_tag}` recebida! Estou validando no clã e aviso aqui em instantes."
+    if not coc_client or not hasattr(coc_client, 'http') or not coc_client.http:
+        # Enquanto o login no CoC não termina, adianta o resultado provável pelo snapshot
+        roster = snapshot_roster()
+        if roster and corrected_tag in roster["members"]:
+            ack += f"\nPrévia: `{roster['members'][corrected_tag]['name']}` aparece na última lista conhecida do clã. {stale_note()}"
+        elif roster:
+            ack += f"\nPrévia: a tag não aparece na última lista conhecida do clã; confirmarei com dados atualizados. {stale_note()}"
+    await interaction.followup.send(ack, ephemeral=True)
 
 # --- Comando /aprovar ---
 @bot.tree.command(name="aprovar", description="[Admin] Aprova o registro de um usuário.")
@@ -435,8 +1142,6 @@ async def register_command(
 )
 async def aprovar_command(interaction: discord.Interaction, usuario: discord.Member, player_tag: str):
     """Aprova um registro pendente, verifica novamente o cargo e atribui."""
-    # Declaração global no início
-    global coc_client
     if not interaction.user.guild_permissions.administrator:
         await interaction.response.send_message("❌ Apenas administradores podem usar este comando.", ephemeral=True)
         return
@@ -448,9 +1153,73 @@ async def aprovar_command(interaction: discord.Interaction, usuario: discord.Mem
         return
     # Usa a global coc_client (declarada acima)
     if not coc_client or not hasattr(coc_client, 'http') or not coc_client.http:
-        await interaction.followup.send("❌ Cliente CoC não está pronto ou desconectado. Tente novamente em breve.", ephemeral=True)
+        await defer_approval(interaction, usuario, player_tag)
+        return
+
+    await perform_approval(interaction, usuario, player_tag)
+
+async def defer_approval(interaction: discord.Interaction, usuario: discord.Member, player_tag: str):
+    """Sem dados ao vivo: mostra uma prévia pelo snapshot e enfileira a aprovação."""
+    corrected_tag = coc.utils.correct_tag(player_tag)
+    if not coc.utils.is_valid_tag(corrected_tag):
+        await interaction.followup.send(f"❌ A tag `{player_tag}` parece inválida.", ephemeral=True)
+        return
+    if any(u.id == usuario.id and coc.utils.correct_tag(t) == corrected_tag for _, u, t in deferred_approvals):
+        await interaction.followup.send(f"ℹ️ A aprovação de {usuario.mention} para `{corrected_tag}` já está na fila.", ephemeral=True)
+        return
+    deferred_approvals.append((interaction, usuario, player_tag))
+    logger.info(f"[APROVAÇÃO] Cliente CoC indisponível; aprovação de {usuario} ({corrected_tag}) por {interaction.user} enfileirada.")
+
+    roster = snapshot_roster()
+    snapshot_member = roster["members"].get(corrected_tag) if roster else None
+    if snapshot_member:
+        preview = f"Prévia: `{snapshot_member['name']}` está no clã como **{snapshot_member['role'].capitalize()}** → cargo {describe_role(interaction.guild, snapshot_member['role'])}.\n{stale_note()}"
+    elif roster:
+        preview = f"Prévia: a tag `{corrected_tag}` **não aparece** na última lista conhecida do clã.\n{stale_note()}"
+    else:
+        preview = "Ainda não há dados salvos do clã para uma prévia."
+    await interaction.followup.send(
+        f"⏳ A conexão com o Clash of Clans ainda está sendo estabelecida. A aprovação de {usuario.mention} foi colocada na fila "
+        f"e será confirmada ao vivo assim que possível; o resultado aparecerá aqui.\n{preview}",
+        ephemeral=True
+    )
+
+async def replay_deferred_approvals():
+    """Executa, com dados ao vivo, as aprovações enfileiradas enquanto o CoC estava indisponível."""
+    pending = list(deferred_approvals)
+    deferred_approvals.clear()
+    logger.info(f"[APROVAÇÃO] Executando {len(pending)} aprovação(ões) enfileirada(s).")
+    for interaction, usuario, player_tag in pending:
+        try:
+            await perform_approval(interaction, usuario, player_tag)
+        except Exception as e:
+            logger.error(f"[APROVAÇÃO] Falha ao executar aprovação enfileirada de {usuario} ({player_tag}): {e}", exc_info=True)
+
+@tasks.loop(minutes=1)
+async def deferred_approval_task():
+    """Drena a fila de aprovações e avisa o admin antes que o token da interação expire."""
+    if not deferred_approvals:
         return
+    now = discord.utils.utcnow()
+    for entry in [e for e in deferred_approvals if (now - e[0].created_at).total_seconds() > DEFERRED_APPROVAL_MAX_WAIT]:
+        interaction, usuario, player_tag = entry
+        deferred_approvals.remove(entry)
+        logger.warning(f"[APROVAÇÃO] Aprovação enfileirada de {usuario} ({player_tag}) expirou sem conexão com o CoC.")
+        try:
+            await interaction.followup.send(
+                f"⌛ A aprovação de {usuario.mention} para `{player_tag}` **ainda não foi feita**: a conexão com o Clash of Clans "
+                f"não voltou a tempo. Use `/aprovar` novamente quando o bot estiver pronto.",
+                ephemeral=True
+            )
+        except Exception as e:
+            logger.warning(f"Falha ao avisar {interaction.user} sobre a aprovação expirada de {usuario}: {e}")
+    if deferred_approvals and coc_client and hasattr(coc_client, 'http') and coc_client.http:
+        await replay_deferred_approvals()
 
+async def perform_approval(interaction: discord.Interaction, usuario: discord.Member, player_tag: str):
+    """Verifica ao vivo o jogador no clã, atribui o cargo e salva o registro (respostas via followup)."""
+    # Declaração global no início
+    global coc_client
     log_channel = bot.get_channel(config.get("log_channel_id")) if config.get("log_channel_id") else None
 
     try:
@@ -477,6 +1246,7 @@ async def aprovar_command(interaction: discord.Interaction, usuario: discord.Mem
         logger.info(f"[APROVAÇÃO] Admin {interaction.user} aprovando {usuario} ({discord_id_str}) para tag {corrected_tag}")
         # Usa a global coc_client (declarada no início da função)
         clan = await asyncio.wait_for(coc_client.get_clan(config["clan_tag"]), timeout=30.0)
+        record_roster(clan)
         member_data = clan.get_member(corrected_tag)
 
         if not member_data:
@@ -529,8 +1299,7 @@ async def aprovar_command(interaction: discord.Interaction, usuario: discord.Mem
             else:
                  logger.info(f"[APROVAÇÃO] Usuário {usuario} já possuía o cargo {role_to_assign.name}. Apenas registrando.")
 
-            registrations[discord_id_str] = corrected_tag
-            if save_json(registrations, REGISTRATIONS_FILE):
+            if save_registration(discord_id_str, corrected_tag):
                 logger.info(f"[APROVAÇÃO] Registro salvo: Discord ID {discord_id_str} -> CoC Tag {corrected_tag}")
 
                 success_message = f"✅ Registro de {usuario.mention} para a tag `{corrected_tag}` (`{player_name}`) como **{role_to_assign.name}** aprovado com sucesso!"
@@ -554,9 +1323,9 @@ async def aprovar_command(interaction: discord.Interaction, usuario: discord.Mem
 
             else:
                  logger.critical(f"[APROVAÇÃO] FALHA AO SALVAR registro para {discord_id_str} -> {corrected_tag} após aprovação!")
-                 await interaction.followup.send("❌ Erro crítico ao salvar o registro no arquivo após a aprovação. O cargo foi dado, mas o registro pode não ter sido salvo permanentemente.", ephemeral=True)
+                 await interaction.followup.send("❌ Erro crítico ao salvar o registro no banco após a aprovação. O cargo foi dado, mas o registro pode não ter sido salvo permanentemente.", ephemeral=True)
                  if log_channel:
-                     try: await log_channel.send(f"🆘 **ERRO CRÍTICO:** Falha ao salvar {REGISTRATIONS_FILE} após aprovar {usuario.mention} (`{corrected_tag}`). O cargo foi dado, mas o registro não foi salvo!")
+                     try: await log_channel.send(f"🆘 **ERRO CRÍTICO:** Falha ao salvar o registro em {SHARED_STATE_DB} após aprovar {usuario.mention} (`{corrected_tag}`). O cargo foi dado, mas o registro não foi salvo!")
                      except Exception: pass
 
         except discord.Forbidden:
@@ -569,7 +1338,7 @@ async def aprovar_command(interaction: discord.Interaction, usuario: discord.Mem
     except coc_errors.NotFound:
         logger.error(f"[APROVAÇÃO] Clã {config['clan_tag']} não encontrado pela API ao aprovar {corrected_tag}.")
         await interaction.followup.send(f"❌ Erro: Clã `{config['clan_tag']}` não encontrado na API CoC ao tentar aprovar.", ephemeral=True)
-    except coc_errors.AuthenticationError:
+    except coc_errors.InvalidCredentials:
         logger.critical("[APROVAÇÃO] Erro de autenticação CoC ao aprovar.")
         # <<< CORREÇÃO: Remover a declaração global redundante daqui >>>
         # A variável coc_client já é global devido à declaração no início da função.
@@ -634,24 +1403,324 @@ async def negar_command(interaction: discord.Interaction, usuario: discord.Membe
     except Exception as e_dm:
         logger.error(f"Erro ao enviar DM de negação para {usuario}: {e_dm}")
 
+# --- Comando /atividade ---
+@bot.tree.command(name="atividade", description="[Admin] Ranking de doações/atividade dos membros do clã.")
+@discord.app_commands.describe(periodo="Janela do ranking.")
+@discord.app_commands.choices(periodo=[
+    discord.app_commands.Choice(name="Semanal", value="semanal"),
+    discord.app_commands.Choice(name="Diário", value="diario"),
+])
+async def atividade_command(interaction: discord.Interaction, periodo: str = "semanal"):
+    """Mostra o ranking pré-calculado de atividade (não consulta a API)."""
+    if not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("❌ Apenas administradores podem usar este comando.", ephemeral=True)
+        return
+    ranking = activity_rankings.get(periodo) or "*(ainda sem dados - aguarde a próxima verificação do clã)*"
+    await interaction.response.send_message(ranking, ephemeral=True)
+
+# --- Importação em Massa ---
+def normalize_name(name):
+    """Normaliza um nome para comparação: sem acentos, minúsculo e só letras/números."""
+    decomposed = unicodedata.normalize("NFKD", name or "")
+    stripped = "".join(c for c in decomposed if not unicodedata.combining(c))
+    return re.sub(r"[^0-9a-z]", "", stripped.casefold())
+
+def _trigrams(normalized):
+    padded = f"  {normalized} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def build_name_index(members):
+    """Pré-calcula os índices exato (nome normalizado -> tags) e por trigramas de um roster."""
+    exact = {}
+    trigrams = {}
+    normalized_names = {}
+    for member in members:
+        normalized = normalize_name(member.name)
+        if not normalized:
+            continue
+        normalized_names[member.tag] = normalized
+        exact.setdefault(normalized, set()).add(member.tag)
+        for gram in _trigrams(normalized):
+            trigrams.setdefault(gram, set()).add(member.tag)
+    return {"exact": exact, "trigrams": trigrams, "names": normalized_names}
+
+def match_name(index, name):
+    """Retorna (tags com nome idêntico após normalização, [(score, tag)] de sugestões aproximadas)."""
+    normalized = normalize_name(name)
+    if len(normalized) < 3:
+        return set(), []
+    exact = index["exact"].get(normalized, set())
+    if exact:
+        return exact, []
+    candidates = set()
+    for gram in _trigrams(normalized):
+        candidates |= index["trigrams"].get(gram, set())
+    scored = []
+    for tag in candidates:
+        score = difflib.SequenceMatcher(None, normalized, index["names"][tag]).ratio()
+        if score >= IMPORT_FUZZY_MIN_SCORE:
+            scored.append((score, tag))
+    scored.sort(reverse=True)
+    return set(), scored
+
+def parse_import_file(filename, content):
+    """Lê pares (discord_id, tag) de um JSON ({id: tag} ou [{discord_id, tag}]) ou CSV (discord_id,tag)."""
+    text = content.decode("utf-8-sig")
+    pairs = []
+    if filename.lower().endswith(".json"):
+        data = json.loads(text)
+        if isinstance(data, dict):
+            pairs = list(data.items())
+        elif isinstance(data, list) and all(isinstance(item, dict) for item in data):
+            pairs = [(item.get("discord_id"), item.get("tag") or item.get("player_tag")) for item in data]
+        else:
+            raise ValueError('o JSON deve ser um objeto {"discord_id": "#TAG"} ou uma lista de {"discord_id": ..., "tag": ...}')
+        for discord_id, tag in pairs:
+            # IDs podem vir como número; tags precisam ser texto
+            if not isinstance(discord_id, (str, int)) or isinstance(discord_id, bool) or not isinstance(tag, str):
+                raise ValueError(f"entrada inválida {json.dumps(discord_id)}: {json.dumps(tag)[:50]} (esperado ID e tag como texto)")
+    else:
+        for row in csv.reader(io.StringIO(text)):
+            if len(row) < 2 or not row[0].strip():
+                continue
+            pairs.append((row[0], row[1]))
+    parsed = []
+    for discord_id, tag in pairs:
+        digits = re.sub(r"\D", "", str(discord_id or ""))
+        if not digits:
+            # Linha de cabeçalho ou ID inválido
+            continue
+        parsed.append((digits, str(tag or "").strip()))
+    return parsed
+
+async def apply_import_link(member, tag, member_data, guild, admin):
+    """Atribui o cargo mapeado ao cargo CoC e remove outros cargos gerenciados. Retorna None ou o erro."""
+    player_role_coc = member_data.role.in_game_name.lower()
+    role = guild.get_role(config.get("roles", {}).get(player_role_coc) or 0)
+    if not role:
+        return f"cargo CoC '{player_role_coc}' sem cargo Discord configurado"
+    if guild.me.top_role <= role:
+        return f"hierarquia insuficiente para o cargo {role.name}"
+    all_managed_role_ids = {r_id for r_id in config.get("roles", {}).values() if r_id}
+    roles_to_remove = [r for r in member.roles if r.id in all_managed_role_ids and r.id != role.id]
+    try:
+        if roles_to_remove:
+            await member.remove_roles(*roles_to_remove, reason=f"Importação em massa ({tag}) por {admin}")
+        if role not in member.roles:
+            await member.add_roles(role, reason=f"Importação em massa por {admin} - Tag: {tag}")
+    except discord.Forbidden:
+        return f"sem permissão para gerenciar o cargo {role.name}"
+    except discord.HTTPException as e:
+        return f"erro do Discord ({e.status})"
+    return None
+
+@bot.tree.command(name="importar", description="[Admin] Vincula membros existentes em massa (arquivo e/ou nomes).")
+@discord.app_commands.describe(
+    arquivo="CSV (discord_id,tag) ou JSON ({discord_id: tag}) com os vínculos a importar.",
+    auto_vincular="Também procura membros do Discord cujo nome corresponde a um nome no clã.",
+    aplicar="Se falso (padrão), apenas mostra o relatório sem alterar nada."
+)
+async def importar_command(interaction: discord.Interaction, arquivo: discord.Attachment = None, auto_vincular: bool = False, aplicar: bool = False):
+    """Valida vínculos (arquivo e/ou correspondência de nomes) contra um único roster e aplica os cargos em lote."""
+    if not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("❌ Apenas administradores podem usar este comando.", ephemeral=True)
+        return
+    await interaction.response.defer(ephemeral=True)
+
+    if not config or "clan_tag" not in config or not config.get("roles"):
+        await interaction.followup.send("❌ O bot não está configurado. Use `/setup`.", ephemeral=True)
+        return
+    if not arquivo and not auto_vincular:
+        await interaction.followup.send("❌ Envie um `arquivo` e/ou ative `auto_vincular`.", ephemeral=True)
+        return
+
+    pairs = []
+    if arquivo:
+        if arquivo.size > IMPORT_MAX_FILE_BYTES:
+            await interaction.followup.send("❌ Arquivo muito grande (máximo 1 MB).", ephemeral=True)
+            return
+        try:
+            pairs = parse_import_file(arquivo.filename, await arquivo.read())
+        except (ValueError, UnicodeDecodeError, csv.Error) as e:
+            logger.warning(f"[IMPORTAÇÃO] Arquivo {arquivo.filename} inválido: {e}")
+            await interaction.followup.send(f"❌ Não consegui ler o arquivo `{arquivo.filename}`: {e}", ephemeral=True)
+            return
+
+    try:
+        clan, wait_reason = await get_admission_roster()
+    except (coc_errors.ClashOfClansException, asyncio.TimeoutError) as e:
+        clan, wait_reason = None, f"a API do Clash of Clans falhou ({type(e).__name__})"
+    if clan is None:
+        await interaction.followup.send(f"⏳ Não foi possível buscar o clã agora porque {wait_reason}. Tente novamente em instantes.", ephemeral=True)
+        return
+
+    guild = interaction.guild
+    tag_owners = {tag: reg_id for reg_id, tag in registrations.items()}
+    linked = [] # (member, tag, member_data, origem)
+    ambiguous = [] # texto
+    rejected = [] # texto
+    claimed_users = set()
+    claimed_tags = {}
+
+    # Linhas idênticas contam uma vez; conflitos (mesma tag para usuários diferentes ou
+    # várias tags para um usuário) não vinculam nenhum dos lados
+    rows = {}
+    for discord_id, raw_tag in pairs:
+        rows.setdefault((discord_id, coc.utils.correct_tag(raw_tag) if raw_tag else ""), raw_tag)
+    ids_by_tag = {}
+    tags_by_id = {}
+    for discord_id, tag in rows:
+        if tag and coc.utils.is_valid_tag(tag):
+            ids_by_tag.setdefault(tag, set()).add(discord_id)
+            tags_by_id.setdefault(discord_id, set()).add(tag)
+
+    for (discord_id, tag), raw_tag in rows.items():
+        member = guild.get_member(int(discord_id))
+        if not member:
+            rejected.append(f"<@{discord_id}> `{raw_tag}`: usuário não está no servidor")
+        elif not tag or not coc.utils.is_valid_tag(tag):
+            rejected.append(f"{member.mention} `{raw_tag}`: tag inválida")
+        elif len(tags_by_id[discord_id]) > 1 or len(ids_by_tag[tag]) > 1:
+            # Fora também do auto_vincular: o conflito precisa ser resolvido pelo admin
+            claimed_users.add(discord_id)
+            claimed_tags[tag] = discord_id
+            if len(tags_by_id[discord_id]) > 1:
+                tags = ", ".join(f"`{t}`" for t in sorted(tags_by_id[discord_id]))
+                ambiguous.append(f"{member.mention} `{tag}`: usuário aparece com várias tags no arquivo ({tags})")
+            else:
+                users = ", ".join(f"<@{d}>" for d in sorted(ids_by_tag[tag]))
+                ambiguous.append(f"{member.mention} `{tag}`: tag aparece para vários usuários no arquivo ({users})")
+        elif not clan.get_member(tag):
+            rejected.append(f"{member.mention} `{tag}`: tag não está no clã")
+        elif tag_owners.get(tag) not in (None, discord_id):
+            rejected.append(f"{member.mention} `{tag}`: tag já registrada para <@{tag_owners[tag]}>")
+        elif registrations.get(discord_id) == tag:
+            rejected.append(f"{member.mention} `{tag}`: já vinculado")
+        else:
+            claimed_users.add(discord_id)
+            claimed_tags[tag] = discord_id
+            linked.append((member, tag, clan.get_member(tag), "arquivo"))
+
+    if auto_vincular:
+        index = build_name_index([m for m in clan.members if m.tag not in tag_owners and m.tag not in claimed_tags])
+        proposals = {} # tag -> [membros]
+        for member in guild.members:
+            discord_id = str(member.id)
+            if member.bot or discord_id in registrations or discord_id in claimed_users:
+                continue
+            exact_tags = set()
+            suggestions = []
+            for name in {member.display_name, member.name}:
+                exact, fuzzy = match_name(index, name)
+                exact_tags |= exact
+                suggestions.extend(fuzzy)
+            if len(exact_tags) == 1:
+                proposals.setdefault(next(iter(exact_tags)), []).append(member)
+            elif len(exact_tags) > 1:
+                names = ", ".join(f"`{t}`" for t in sorted(exact_tags))
+                ambiguous.append(f"{member.mention}: nome corresponde a vários jogadores ({names})")
+            elif suggestions:
+                score, tag = max(suggestions)
+                ambiguous.append(f"{member.mention}: parecido com `{clan.get_member(tag).name}` `{tag}` ({score:.0%}) - confirme com `/aprovar`")
+        for tag, members in proposals.items():
+            if len(members) == 1:
+                linked.append((members[0], tag, clan.get_member(tag), "nome"))
+            else:
+                mentions = ", ".join(m.mention for m in members)
+                ambiguous.append(f"`{clan.get_member(tag).name}` `{tag}`: vários membros do Discord com esse nome ({mentions})")
+
+    if aplicar and linked:
+        applied = []
+        for member, tag, member_data, origin in linked:
+            error = await apply_import_link(member, tag, member_data, guild, interaction.user)
+            if error:
+                rejected.append(f"{member.mention} `{tag}`: {error}")
+            else:
+                applied.append((member, tag, member_data, origin))
+            await asyncio.sleep(IMPORT_ROLE_EDIT_DELAY)
+        linked = applied
+        if applied and not save_registrations((member.id, tag) for member, tag, _, _ in applied):
+            logger.critical(f"[IMPORTAÇÃO] FALHA AO SALVAR registros em {SHARED_STATE_DB} após vincular {len(applied)} membro(s)!")
+            await interaction.followup.send(f"🆘 Erro crítico ao salvar os registros em {SHARED_STATE_DB}. Os cargos foram dados, mas os registros podem não ter sido salvos.", ephemeral=True)
+
+    verb = "Vinculados" if aplicar else "Seriam vinculados"
+    report_lines = [f"# Relatório de importação ({'aplicado' if aplicar else 'simulação'})", "", f"## {verb} ({len(linked)})"]
+    report_lines += [f"- {m.display_name} ({m.id}) -> {t} {d.name} [{o}]" for m, t, d, o in linked]
+    report_lines += ["", f"## Ambíguos ({len(ambiguous)})"] + [f"- {line}" for line in ambiguous]
+    report_lines += ["", f"## Rejeitados ({len(rejected)})"] + [f"- {line}" for line in rejected]
+    report = discord.File(io.BytesIO("\n".join(report_lines).encode("utf-8")), filename="relatorio_importacao.md")
+    summary = f"{'✅' if aplicar else '🔎'} **Importação {'concluída' if aplicar else '(simulação)'}:** {verb.lower()}: **{len(linked)}** · ambíguos: **{len(ambiguous)}** · rejeitados: **{len(rejected)}**"
+    if not aplicar and linked:
+        summary += "\nUse `aplicar: True` para efetivar os vínculos."
+    logger.info(f"[IMPORTAÇÃO] {interaction.user}: {len(linked)} vinculados, {len(ambiguous)} ambíguos, {len(rejected)} rejeitados (aplicar={aplicar}).")
+    await interaction.followup.send(summary, file=report, ephemeral=True)
+
+    log_channel = bot.get_channel(config.get("log_channel_id")) if config.get("log_channel_id") else None
+    if aplicar and linked and log_channel:
+        try: await log_channel.send(f"📥 **{interaction.user.mention}** importou {len(linked)} vínculo(s) em massa ({len(ambiguous)} ambíguos, {len(rejected)} rejeitados).")
+        except Exception: pass
+
+# --- Comando /jogador ---
+@bot.tree.command(name="jogador", description="Mostra o perfil CoC de um membro registrado ou de uma tag.")
+@discord.app_commands.describe(
+    usuario="Membro do Discord registrado (opcional).",
+    player_tag="Tag CoC do jogador (opcional, usada se nenhum usuário for informado)."
+)
+async def jogador_command(interaction: discord.Interaction, usuario: discord.Member = None, player_tag: str = None):
+    """Mostra o perfil de um jogador a partir do cache de perfis, buscando na API só se necessário."""
+    await interaction.response.defer(ephemeral=True)
+
+    if usuario:
+        corrected_tag = registrations.get(str(usuario.id))
+        if not corrected_tag:
+            await interaction.followup.send(f"❌ {usuario.mention} não está registrado.", ephemeral=True)
+            return
+    elif player_tag:
+        corrected_tag = coc.utils.correct_tag(player_tag)
+        if not coc.utils.is_valid_tag(corrected_tag):
+            await interaction.followup.send(f"❌ A tag `{player_tag}` parece inválida.", ephemeral=True)
+            return
+    else:
+        await interaction.followup.send("❌ Informe um `usuario` ou uma `player_tag`.", ephemeral=True)
+        return
+
+    entry = (await enrich_players([corrected_tag])).get(corrected_tag)
+    if not entry:
+        await interaction.followup.send(f"❌ Não consegui obter o perfil da tag `{corrected_tag}` agora. Tente novamente mais tarde.", ephemeral=True)
+        return
+
+    owner = f" ({usuario.mention})" if usuario else ""
+    await interaction.followup.send(f"🔖 **{entry['name']}** `{corrected_tag}`{owner}\n📊 {format_player_summary(entry)}", ephemeral=True)
+
 # --- Função auxiliar para verificar e atualizar um único membro ---
-async def verify_single_member(member: discord.Member, expected_tag: str, guild: discord.Guild):
-    """Verifica o status CoC de um membro específico e atualiza cargos/expulsa se necessário."""
+async def verify_single_member(member: discord.Member, expected_tag: str, guild: discord.Guild, clan=None):
+    """Verifica o status CoC de um membro específico e atualiza cargos/expulsa se necessário.
+
+    Se `clan` for passado (ex: pela verificação periódica), reutiliza esse roster em vez de buscar o clã novamente.
+    Retorna False se a verificação falhou por um erro transitório (timeout, API CoC ou Discord
+    instáveis) e vale a pena tentar de novo; True caso contrário.
+    """
     # Declaração global no início da função
     global coc_client
     global registrations
 
     # Usa as globais (declaradas acima)
-    if not coc_client or not config or not guild:
-        logger.debug(f"Skipping single verify for {member}: coc_client ou config indisponível.")
-        return
+    if not config or not guild:
+        logger.debug(f"Skipping single verify for {member}: config ou servidor indisponível.")
+        return True
+    if clan is None and not coc_client:
+        # Sem roster e sem cliente (ex: relogin falhou): transitório, não conta como verificado
+        logger.debug(f"Verificação de {member} adiada: cliente CoC indisponível e sem roster.")
+        return False
 
     discord_id_str = str(member.id)
     logger.debug(f"Verificando membro individual: {member} ({discord_id_str}), tag esperada: {expected_tag}")
 
     try:
         # Usa a global coc_client
-        clan = await asyncio.wait_for(coc_client.get_clan(config["clan_tag"]), timeout=20.0)
+        if clan is None:
+            clan = await asyncio.wait_for(coc_client.get_clan(config["clan_tag"]), timeout=20.0)
+            record_roster(clan)
         member_data = clan.get_member(expected_tag)
 
         current_roles = {role.id for role in member.roles}
@@ -666,7 +1735,7 @@ async def verify_single_member(member: discord.Member, expected_tag: str, guild:
 
             if not expected_role:
                 logger.error(f"Cargo Discord para CoC role '{player_role_coc}' (ID: {expected_role_id}) não encontrado ou não configurado para {member}.")
-                return
+                return True
 
             if expected_role_id not in current_roles:
                 logger.info(f"Membro {member} ({expected_tag}) está no clã como {player_role_coc}, mas sem o cargo {expected_role.name}. Adicionando...")
@@ -698,8 +1767,7 @@ async def verify_single_member(member: discord.Member, expected_tag: str, guild:
 
             # Usa a global registrations (declarada no início da função)
             if discord_id_str in registrations:
-                 del registrations[discord_id_str]
-                 save_json(registrations, REGISTRATIONS_FILE)
+                 delete_registration(discord_id_str)
                  logger.info(f"Registro de {member} ({discord_id_str}) removido.")
 
             kick_msg = config.get("kick_message", "Você foi removido do servidor por não fazer mais parte do clã.")
@@ -735,26 +1803,39 @@ async def verify_single_member(member: discord.Member, expected_tag: str, guild:
 
     except coc_errors.NotFound:
         logger.warning(f"Clã {config['clan_tag']} não encontrado durante verificação de {member}.")
-    except coc_errors.AuthenticationError:
+    except coc_errors.InvalidCredentials:
         logger.critical(f"Erro de autenticação CoC durante verificação de {member}. Tentando relogar...")
         # Usa a global coc_client (declarada no início da função)
         coc_client = None
         await initialize_coc_client() # Tenta reinicializar o cliente global
+        return False
     except coc_errors.ClashOfClansException as e_coc:
         logger.error(f"Erro API CoC ao verificar {member} ({expected_tag}): {e_coc}")
+        return False
     except asyncio.TimeoutError:
         logger.warning(f"Timeout ao verificar {member} ({expected_tag}).")
+        return False
+    except discord.DiscordServerError as e_discord:
+        logger.warning(f"Erro do servidor Discord ao atualizar {member} ({expected_tag}): {e_discord}")
+        return False
     except Exception as e:
         logger.error(f"Erro inesperado ao verificar membro {member}: {e}", exc_info=True)
+    return True
 
 
 # --- Tarefa de Verificação Periódica ---
-@tasks.loop(hours=1)
+@tasks.loop(hours=SWEEP_INTERVAL_HOURS)
 async def verify_members_task():
-    """Verifica periodicamente todos os membros registrados."""
+    """Verifica periodicamente todos os membros registrados, um bucket por lease."""
     # Declaração global no início da função
     global coc_client
     global registrations
+    global last_sweep_at
+    global config
+
+    if SHARD_COUNT:
+        # O /setup roda em outro worker; relê a configuração compartilhada
+        config = load_json(CONFIG_FILE) or config
 
     # Usa as globais (declaradas acima)
     if not coc_client or not hasattr(coc_client, 'http') or not coc_client.http:
@@ -763,47 +1844,461 @@ async def verify_members_task():
     if not config or "clan_tag" not in config:
         logger.warning("Skipping verify_members_task: Configuração do bot (clan_tag) ausente.")
         return
-    if not bot.guilds:
-        logger.warning("Skipping verify_members_task: Bot não está em nenhum servidor.")
+
+    guild = get_registration_guild()
+    if guild and config.get("guild_id") != guild.id:
+        # Guarda o ID do servidor para que workers sem esse shard possam buscá-lo via REST
+        config["guild_id"] = guild.id
+        save_json(config, CONFIG_FILE)
+    if not guild and SHARD_COUNT:
+        try:
+            guild = await fetch_registration_guild()
+        except discord.HTTPException as e:
+            logger.warning(f"Skipping verify_members_task: Falha ao buscar o servidor de registro via REST: {e}")
+            return
+    if not guild:
+        logger.warning("Skipping verify_members_task: Servidor de registro não encontrado.")
         return
 
+    # Outros workers (e comandos) podem ter alterado os registros desde a última leitura
+    fresh = await asyncio.to_thread(load_registrations)
+    if fresh is not None:
+        registrations = fresh
+    fresh_state = await asyncio.to_thread(load_sweep_state)
+    if fresh_state is not None:
+        sweep_state.clear()
+        sweep_state.update(fresh_state)
     regs_copy = registrations.copy()
 
-    logger.info(f"--- Iniciando Tarefa de Verificação Periódica ({len(regs_copy)} membros registrados) ---")
-    guild = bot.guilds[0]
-    if not guild:
-        logger.error("Não foi possível obter o objeto Guild na tarefa de verificação.")
-        return
+    logger.info(f"--- Iniciando Tarefa de Verificação Periódica ({len(regs_copy)} membros registrados, {SWEEP_BUCKETS} bucket(s)) ---")
+
+    # Um único roster para toda a verificação, em vez de um get_clan por membro
+    try:
+        clan = await asyncio.wait_for(coc_client.get_clan(config["clan_tag"]), timeout=30.0)
+    except (coc_errors.ClashOfClansException, asyncio.TimeoutError) as e:
+        logger.warning(f"Não foi possível buscar o roster do clã para a verificação ({type(e).__name__}). Cada membro buscará o clã individualmente.")
+        clan = None
+    if clan:
+        record_roster(clan)
+        # Aquece o cache de perfis para que aprovações e /jogador não precisem esperar a API
+        spawn_background(enrich_players([m.tag for m in clan.members]))
 
     verified_count = 0
+    unchanged_count = 0
+    skipped_buckets = 0
+    managed_role_ids = {r_id for r_id in config.get("roles", {}).values() if r_id}
+    unresolved = [] # (discord_id, tag) que continuaram falhando após as retentativas ou não foram verificados
+    # Heap de (quando, seq, discord_id, tag, tentativa, prazo) com membros que falharam de forma transitória.
+    # Vale para a verificação inteira: um membro instável não segura o bucket, e as retentativas
+    # vencidas são intercaladas com os próximos buckets.
+    retry_heap = []
+    retry_seq = itertools.count()
     start_time = datetime.now()
+    # Buckets concluídos são marcados para o ciclo atual (janela de SWEEP_INTERVAL_HOURS do relógio),
+    # então nenhum worker os repete neste ciclo e todos voltam a ser verificados no próximo
+    sweep_period = SWEEP_INTERVAL_HOURS * 3600
+    cycle = int(time.time() // sweep_period)
+    await purge_expired_leases()
+
+    # Cada worker começa por uma ordem aleatória e pega qualquer bucket cujo lease esteja livre;
+    # buckets ocupados voltam para o fim da fila até serem liberados ou marcados como concluídos.
+    pending_buckets = deque(random.sample(range(SWEEP_BUCKETS), SWEEP_BUCKETS))
+    busy_streak = 0
+    sweep_deadline = time.monotonic() + SWEEP_INTERVAL_HOURS * 3600 / 2
+    current = None # (bucket, lease_key, done_key, work) do bucket em andamento
+    lease_renewed_at = 0.0
 
-    for discord_id_str, player_tag in regs_copy.items():
-        member = guild.get_member(int(discord_id_str))
-        if not member:
-            logger.warning(f"Membro registrado ID {discord_id_str} (tag: {player_tag}) não encontrado no servidor {guild.name}. Removendo registro.")
-            # Usa a global registrations (declarada no início da função)
-            if discord_id_str in registrations:
-                del registrations[discord_id_str]
-                if not save_json(registrations, REGISTRATIONS_FILE):
-                     logger.error(f"Falha ao salvar {REGISTRATIONS_FILE} após remover membro {discord_id_str} não encontrado.")
-            continue
+    try:
+        while time.monotonic() < sweep_deadline:
+            if current and time.monotonic() - lease_renewed_at > LEASE_TTL / 3:
+                if not await acquire_lease(current[1]):
+                    logger.warning(f"Lease do bucket {current[0]} perdido durante a verificação. Interrompendo o bucket.")
+                    unresolved.extend(current[3])
+                    current = None
+                    continue
+                lease_renewed_at = time.monotonic()
+            if current and not current[3]:
+                # Bucket percorrido; retentativas pendentes continuam no heap da verificação
+                await acquire_lease(current[2], ttl=2 * sweep_period)
+                await release_lease(current[1])
+                current = None
+                continue
+
+            now = time.monotonic()
+            if retry_heap and retry_heap[0][0] <= now:
+                _, _, discord_id_str, player_tag, attempt, deadline = heapq.heappop(retry_heap)
+                logger.info(f"Retentativa {attempt} da verificação de {discord_id_str} ({player_tag}).")
+            elif current:
+                discord_id_str, player_tag = current[3].popleft()
+                attempt, deadline = 0, None
+            elif pending_buckets:
+                bucket = pending_buckets.popleft()
+                lease_key = f"sweep:{config['clan_tag']}:{guild.id}:{bucket}"
+                done_key = f"{lease_key}:{cycle}"
+                if await is_lease_active(done_key):
+                    skipped_buckets += 1
+                    continue
+                if not await acquire_lease(lease_key):
+                    pending_buckets.append(bucket)
+                    busy_streak += 1
+                    if busy_streak >= len(pending_buckets):
+                        # Todos os restantes estão com outros workers: espera algum lease vagar (ou a próxima retentativa)
+                        wait = SWEEP_LEASE_POLL_SECONDS
+                        if retry_heap:
+                            wait = max(0.0, min(wait, retry_heap[0][0] - now))
+                        await asyncio.sleep(wait)
+                        busy_streak = 0
+                    continue
+                busy_streak = 0
+                if await is_lease_active(done_key):
+                    # Concluído por outro worker entre a consulta e a aquisição
+                    await release_lease(lease_key)
+                    skipped_buckets += 1
+                    continue
+                work = deque((d, t) for d, t in regs_copy.items() if int(d) % SWEEP_BUCKETS == bucket)
+                current = (bucket, lease_key, done_key, work)
+                lease_renewed_at = time.monotonic()
+                continue
+            elif retry_heap:
+                await asyncio.sleep(min(retry_heap[0][0] - now, LEASE_TTL / 3))
+                continue
+            else:
+                break
+
+            member = guild.get_member(int(discord_id_str))
+            if not member:
+                logger.warning(f"Membro registrado ID {discord_id_str} (tag: {player_tag}) não encontrado no servidor {guild.name}. Removendo registro.")
+                # Usa a global registrations (declarada no início da função)
+                clear_sweep_state(discord_id_str)
+                if not delete_registration(discord_id_str):
+                    logger.error(f"Falha ao remover do banco o registro do membro {discord_id_str} não encontrado.")
+                continue
+
+            if clan is None and attempt and coc_client:
+                # A falha pode ter sido do roster compartilhado; tenta recuperá-lo para os próximos
+                try:
+                    clan = await asyncio.wait_for(coc_client.get_clan(config["clan_tag"]), timeout=30.0)
+                    record_roster(clan)
+                except (coc_errors.ClashOfClansException, asyncio.TimeoutError):
+                    pass
 
-        await verify_single_member(member, player_tag, guild)
-        verified_count += 1
-        await asyncio.sleep(0.5)
+            member_data = clan.get_member(player_tag) if clan else None
+            if member_data and not attempt:
+                # Sem mudança desde a última verificação (inclusive antes de um reinício): nada a fazer
+                coc_role = member_data.role.in_game_name.lower()
+                current_managed = {r.id for r in member.roles} & managed_role_ids
+                if sweep_state.get(discord_id_str) == [player_tag, coc_role] and current_managed == {config["roles"].get(coc_role)}:
+                    unchanged_count += 1
+                    continue
+
+            if await verify_single_member(member, player_tag, guild, clan=clan):
+                verified_count += 1
+                if member_data:
+                    set_sweep_state(discord_id_str, player_tag, member_data.role.in_game_name.lower())
+                else:
+                    clear_sweep_state(discord_id_str)
+            else:
+                deadline = deadline or time.monotonic() + SWEEP_RETRY_DEADLINE
+                delay = min(SWEEP_RETRY_MAX_DELAY, SWEEP_RETRY_BASE_DELAY * 2 ** attempt) * random.uniform(0.5, 1.5)
+                if time.monotonic() + delay > deadline:
+                    logger.warning(f"Verificação de {member} ({player_tag}) não resolvida após {attempt + 1} tentativa(s).")
+                    unresolved.append((discord_id_str, player_tag))
+                else:
+                    heapq.heappush(retry_heap, (time.monotonic() + delay, next(retry_seq), discord_id_str, player_tag, attempt + 1, deadline))
+            await asyncio.sleep(0.5)
+    finally:
+        if current:
+            await release_lease(current[1])
+
+    # Prazo esgotado: tudo o que ficou para trás entra no resumo dos não resolvidos
+    if current:
+        unresolved.extend(current[3])
+    unresolved.extend((d, t) for _, _, d, t, _, _ in sorted(retry_heap))
+    unfinished = []
+    for bucket in pending_buckets:
+        lease_key = f"sweep:{config['clan_tag']}:{guild.id}:{bucket}"
+        if await is_lease_active(f"{lease_key}:{cycle}") or await is_lease_active(lease_key):
+            # Concluído ou ainda em andamento em outro worker, que reporta os próprios membros
+            continue
+        unfinished.append(bucket)
+        unresolved.extend((d, t) for d, t in regs_copy.items() if int(d) % SWEEP_BUCKETS == bucket)
+    if unfinished:
+        logger.warning(f"{len(unfinished)} bucket(s) não foram iniciados a tempo neste ciclo: {sorted(unfinished)}")
 
     end_time = datetime.now()
     duration = (end_time - start_time).total_seconds()
     logger.info(f"--- Tarefa de Verificação Periódica Concluída ---")
-    logger.info(f"Verificados: {verified_count} membros em {duration:.2f} segundos.")
+    logger.info(f"Verificados: {verified_count} membros em {duration:.2f} segundos ({unchanged_count} sem mudanças, {skipped_buckets} bucket(s) já concluídos neste ciclo).")
+    last_sweep_at = time.time()
+    await asyncio.to_thread(save_json, build_warm_snapshot(), WARM_SNAPSHOT_FILE)
+    if unresolved:
+        logger.warning(f"{len(unresolved)} membro(s) não resolvidos nesta verificação: {unresolved}")
+        log_channel = guild.get_channel(config.get("log_channel_id")) if config.get("log_channel_id") else None
+        if log_channel:
+            lines = [f"⚠️ **Verificação periódica:** {len(unresolved)} membro(s) não puderam ser verificados por falhas temporárias e serão tentados no próximo ciclo:"]
+            lines.extend(f" - <@{d}> (`{t}`)" for d, t in unresolved)
+            await send_in_batches(log_channel, lines)
+
+# --- Envio em Lotes ---
+async def send_in_batches(channel, lines):
+    """Agrupa linhas em mensagens de até DISCORD_MESSAGE_LIMIT caracteres e envia em sequência.
+
+    Retorna quantas linhas foram enviadas com sucesso (as seguintes ficam para a próxima tentativa).
+    """
+    sent_lines = 0
+    chunk = []
+    chunk_len = 0
+    for line in lines + [None]:
+        if line is not None and chunk_len + len(line) + 1 <= DISCORD_MESSAGE_LIMIT:
+            chunk.append(line)
+            chunk_len += len(line) + 1
+            continue
+        if chunk:
+            try:
+                await channel.send("\n".join(chunk))
+            except Exception as e:
+                logger.error(f"Falha ao enviar lote de {len(chunk)} linha(s) para {channel}: {e}")
+                return sent_lines
+            sent_lines += len(chunk)
+            await asyncio.sleep(1)
+        chunk = [line] if line is not None else []
+        chunk_len = len(line) + 1 if line is not None else 0
+    return sent_lines
+
+# --- Log de Guerras e Raids ---
+def _remember(index, key):
+    """Adiciona `key` a um índice de deduplicação (lista), mantendo só as entradas mais recentes."""
+    index.append(key)
+    del index[:-WAR_LOG_INDEX_SIZE]
+
+def format_war_result(clan, opponent, result):
+    """Formata o resultado final de uma guerra (da guerra atual ou do war log)."""
+    result_display = {"won": "🏆 Vitória", "win": "🏆 Vitória", "lost": "💀 Derrota", "lose": "💀 Derrota", "tie": "🤝 Empate"}.get(result, "🏁 Guerra encerrada")
+    return (
+        f"{result_display} contra **{opponent.name}** (`{opponent.tag}`): "
+        f"⭐ {clan.stars} x {opponent.stars} · 💥 {clan.destruction:.1f}% x {opponent.destruction:.1f}%"
+    )
+
+def format_war_attack(attack):
+    """Formata um ataque de guerra em uma linha."""
+    attacker, defender = attack.attacker, attack.defender
+    icon = "🛡️" if attacker.is_opponent else "⚔️"
+    fresh = " 🆕" if attack.is_fresh_attack else ""
+    return (
+        f"{icon} `{attacker.name}` (#{attacker.map_position}) → `{defender.name}` (#{defender.map_position}): "
+        f"{'⭐' * attack.stars or '✖️'} {attack.destruction:.0f}%{fresh}"
+    )
+
+@tasks.loop(minutes=5)
+async def war_log_task():
+    """Consulta a guerra atual, o war log e o log de raids, postando apenas eventos novos.
+
+    Ataques são deduplicados pela ordem (`order`) já postada em cada guerra; guerras e raids encerradas
+    pelo identificador guardado em WAR_LOG_STATE_FILE. O intervalo se adapta ao estado da guerra.
+    """
+    global war_log_state
+
+    if not coc_client or not hasattr(coc_client, 'http') or not coc_client.http:
+        return
+    if not config or not config.get("clan_tag") or not config.get("war_log_channel_id"):
+        return
+    channel = bot.get_channel(config["war_log_channel_id"])
+    if not channel:
+        # Com vários workers, só quem tem o canal em cache posta
+        return
+    lease_key = f"warlog:{config['clan_tag']}"
+    if not await acquire_lease(lease_key):
+        logger.debug("Log de guerras já está sendo processado por outro worker.")
+        return
+
+    war_state = "notInWar"
+    try:
+        if SHARD_COUNT:
+            war_log_state = load_json(WAR_LOG_STATE_FILE)
+        attack_orders = war_log_state.setdefault("attack_orders", {})
+        posted_wars = war_log_state.setdefault("posted_wars", [])
+        posted_raids = war_log_state.setdefault("posted_raids", [])
+        # Na primeira execução, o histórico existente é só indexado (sem postar) para não inundar o canal
+        backfill = not war_log_state.get("initialized")
+        lines = []
+        # (linhas que precisam ter sido enviadas, ação) - aplicadas ao índice só após o envio
+        marks = []
+
+        try:
+            war = await asyncio.wait_for(coc_client.get_current_war(config["clan_tag"]), timeout=30.0)
+        except coc_errors.PrivateWarLog:
+            logger.warning(f"War log do clã {config['clan_tag']} é privado. Não é possível acompanhar guerras.")
+            war = None
+
+        current_result_key = None
+        if war:
+            war_state = war.state
+        if war and war.state in ("inWar", "warEnded"):
+            war_key = f"{war.clan.tag}:{war.opponent.tag}:{war.preparation_start_time.raw_time}"
+            last_order = attack_orders.get(war_key, 0)
+            new_attacks = sorted((a for a in war.attacks if a.order > last_order), key=lambda a: a.order)
+            if backfill:
+                if new_attacks:
+                    marks.append((len(lines), lambda order=new_attacks[-1].order: attack_orders.__setitem__(war_key, order)))
+            else:
+                if new_attacks and last_order == 0:
+                    lines.append(f"⚔️ **Guerra contra {war.opponent.name}** (`{war.opponent.tag}`)")
+                for attack in new_attacks:
+                    lines.append(format_war_attack(attack))
+                    marks.append((len(lines), lambda order=attack.order: attack_orders.__setitem__(war_key, order)))
+            if war.state == "warEnded":
+                result_key = f"{war.opponent.tag}:{war.end_time.raw_time}"
+                if result_key not in posted_wars:
+                    if not backfill:
+                        lines.append(format_war_result(war.clan, war.opponent, war.status))
+                    marks.append((len(lines), lambda key=result_key: _remember(posted_wars, key)))
+                    current_result_key = result_key
+
+        try:
+            war_log = await asyncio.wait_for(coc_client.get_war_log(config["clan_tag"], limit=5), timeout=30.0)
+            for entry in reversed(list(war_log)):
+                if entry.is_league_entry or not entry.opponent:
+                    continue
+                result_key = f"{entry.opponent.tag}:{entry.end_time.raw_time}"
+                if result_key in posted_wars or result_key == current_result_key:
+                    continue
+                if not backfill:
+                    lines.append(format_war_result(entry.clan, entry.opponent, entry.result))
+                marks.append((len(lines), lambda key=result_key: _remember(posted_wars, key)))
+        except coc_errors.PrivateWarLog:
+            logger.debug(f"War log do clã {config['clan_tag']} é privado; usando apenas a guerra atual.")
+        except (coc_errors.ClashOfClansException, asyncio.TimeoutError) as e:
+            # Não impede que a guerra atual e as raids sejam postadas
+            logger.warning(f"Falha ao consultar war log ({type(e).__name__}); tentando na próxima consulta.")
+
+        try:
+            raid_log = await asyncio.wait_for(coc_client.get_raid_log(config["clan_tag"], limit=1), timeout=30.0)
+        except (coc_errors.ClashOfClansException, asyncio.TimeoutError) as e:
+            # Inclui PrivateWarLog e manutenção: os posts de guerra e o índice seguem normalmente
+            logger.warning(f"Falha ao consultar log de raids ({type(e).__name__}); tentando na próxima consulta.")
+            raid_log = []
+        for raid in raid_log:
+            raid_key = str(raid.start_time.raw_time)
+            if raid.state != "ended" or raid_key in posted_raids:
+                continue
+            if not backfill:
+                lines.append(
+                    f"🏰 **Fim de semana de raid encerrado:** 💰 {raid.total_loot} de ouro da capital · "
+                    f"⚔️ {raid.attack_count} ataques · 🏚️ {raid.destroyed_district_count} distritos destruídos · "
+                    f"🏅 {raid.offensive_reward + raid.defensive_reward} medalhas"
+                )
+            marks.append((len(lines), lambda key=raid_key: _remember(posted_raids, key)))
+
+        sent = await send_in_batches(channel, lines) if lines else 0
+        for required, apply_mark in marks:
+            if sent >= required:
+                apply_mark()
+        # Mantém só as guerras mais recentes no índice de ataques
+        for old_key in list(attack_orders)[:-WAR_LOG_INDEX_SIZE]:
+            del attack_orders[old_key]
+        if sent < len(lines):
+            logger.warning(f"Log de guerras: apenas {sent}/{len(lines)} linha(s) enviadas; o restante será tentado na próxima consulta.")
+        war_log_state["initialized"] = True
+        await asyncio.to_thread(save_json, war_log_state, WAR_LOG_STATE_FILE)
+        if lines:
+            logger.info(f"Log de guerras: {sent} linha(s) postadas em {channel.name} (estado da guerra: {war_state}).")
+
+    except coc_errors.ClashOfClansException as e_coc:
+        logger.error(f"Erro API CoC ({type(e_coc).__name__}) ao consultar log de guerras: {e_coc}")
+    except asyncio.TimeoutError:
+        logger.warning("Timeout ao consultar log de guerras.")
+    except Exception as e:
+        logger.error(f"Erro inesperado no log de guerras: {e}", exc_info=True)
+    finally:
+        await release_lease(lease_key)
+
+    new_interval = WAR_POLL_MINUTES.get(war_state, 30)
+    if war_log_task.minutes != new_interval:
+        war_log_task.change_interval(minutes=new_interval)
+        logger.info(f"Intervalo do log de guerras ajustado para {new_interval} min.")
+
+# --- Watchdog do Event Loop ---
+LOOP_LAG_INTERVAL = 0.5
+loop_lag_samples = deque(maxlen=240) # ~2 minutos de amostras
+loop_heartbeat = None # time.monotonic() do último tick do watchdog
+loop_thread_id = None
+
+async def loop_lag_watchdog():
+    """Mede continuamente o atraso de agendamento do event loop."""
+    global loop_heartbeat, loop_thread_id
+    loop = asyncio.get_running_loop()
+    loop_thread_id = threading.get_ident()
+    loop_heartbeat = time.monotonic()
+    while True:
+        scheduled = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = max(0.0, loop.time() - scheduled - LOOP_LAG_INTERVAL)
+        loop_lag_samples.append(lag)
+        loop_heartbeat = time.monotonic()
+        if lag > SLOW_CALLBACK_THRESHOLD:
+            logger.warning(f"Event loop atrasou {lag:.3f}s (limite {SLOW_CALLBACK_THRESHOLD}s).")
+
+def slow_callback_monitor(stop_event):
+    """Thread que detecta o loop travado e loga o stack trace do callback responsável."""
+    reported_heartbeat = None
+    while not stop_event.wait(SLOW_CALLBACK_THRESHOLD / 2):
+        heartbeat = loop_heartbeat
+        if heartbeat is None or heartbeat == reported_heartbeat:
+            continue
+        stalled_for = time.monotonic() - heartbeat - LOOP_LAG_INTERVAL
+        if stalled_for < SLOW_CALLBACK_THRESHOLD:
+            continue
+        frame = sys._current_frames().get(loop_thread_id)
+        if frame is None:
+            continue
+        stack = "".join(traceback.format_stack(frame))
+        logger.warning(f"Event loop bloqueado há {stalled_for:.2f}s. Stack do callback em execução:\n{stack}")
+        # Loga uma vez por travamento
+        reported_heartbeat = heartbeat
+
+def get_loop_lag_stats():
+    """Retorna percentis (em segundos) do atraso do loop e o estado derivado deles."""
+    samples = sorted(loop_lag_samples)
+    def percentile(p):
+        if not samples:
+            return 0.0
+        return samples[min(len(samples) - 1, int(p / 100 * len(samples)))]
+    stats = {
+        "p50": percentile(50),
+        "p95": percentile(95),
+        "p99": percentile(99),
+        "max": samples[-1] if samples else 0.0,
+        "samples": len(samples),
+    }
+    stalled_for = time.monotonic() - loop_heartbeat if loop_heartbeat is not None else 0.0
+    if loop_heartbeat is None or stalled_for > LOOP_LAG_UNHEALTHY + LOOP_LAG_INTERVAL or stats["p99"] > LOOP_LAG_UNHEALTHY:
+        stats["state"] = "unhealthy"
+    elif stats["p95"] > LOOP_LAG_DEGRADED:
+        stats["state"] = "degraded"
+    else:
+        stats["state"] = "ok"
+    return stats
 
 # --- Handler do Health Check para Render.com ---
 async def health_check(request):
-    """Responde com HTTP 200 OK para indicar que o serviço está rodando."""
+    """Liveness: responde com HTTP 200 OK para indicar que o processo está rodando."""
     logger.debug("Health check recebido.")
     return web.Response(text="OK", status=200)
 
+async def readiness_check(request):
+    """Readiness: 503 se o event loop estiver travando ou o bot não estiver conectado ao Discord."""
+    stats = get_loop_lag_stats()
+    discord_ready = bot.is_ready() and not bot.is_closed()
+    state = stats["state"] if discord_ready else "unhealthy"
+    body = {
+        "state": state,
+        "discord_ready": discord_ready,
+        "loop_lag": {k: round(v, 4) if isinstance(v, float) else v for k, v in stats.items() if k != "state"},
+    }
+    if state == "unhealthy":
+        logger.warning(f"Readiness check retornando 503: {body}")
+    return web.json_response(body, status=503 if state == "unhealthy" else 200)
+
 # --- Função Principal (main) ---
 async def main():
     """Configura o servidor web auxiliar e inicia o bot Discord."""
@@ -812,6 +2307,7 @@ async def main():
 
     app = web.Application()
     app.router.add_get('/', health_check)
+    app.router.add_get('/ready', readiness_check)
     runner = web.AppRunner(app)
     await runner.setup()
     site = web.TCPSite(runner, '0.0.0.0', PORT)
@@ -822,6 +2318,20 @@ async def main():
         logger.critical(f"Falha ao iniciar o servidor web auxiliar na porta {PORT}: {e}", exc_info=True)
         logger.warning("Tentando iniciar o bot Discord mesmo sem o servidor web auxiliar (PODE NÃO FUNCIONAR NO RENDER)...")
 
+    watchdog_task = asyncio.create_task(loop_lag_watchdog())
+    monitor_stop = threading.Event()
+    threading.Thread(target=slow_callback_monitor, args=(monitor_stop,), name="slow-callback-monitor", daemon=True).start()
+    logger.info(f"Watchdog do event loop iniciado (limite de callback lento: {SLOW_CALLBACK_THRESHOLD}s).")
+
+    # Uma única vez por processo: reconexões (on_ready) não devem sobrescrever o estado em memória
+    load_warm_snapshot()
+
+    # O Render encerra instâncias com SIGTERM: fecha o bot para que o finally (snapshot etc.) rode
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: spawn_background(bot.close()))
+    except (NotImplementedError, RuntimeError):
+        logger.warning("Não foi possível registrar o handler de SIGTERM nesta plataforma.")
+
     try:
         logger.info("Iniciando bot Discord...")
         await bot.start(TOKEN)
@@ -831,6 +2341,10 @@ async def main():
         logger.critical(f"Erro fatal durante a execução do bot: {e}", exc_info=True)
     finally:
         logger.info("Parando o bot e limpando recursos...")
+        monitor_stop.set()
+        watchdog_task.cancel()
+        if (roster_snapshot or sweep_state) and save_json(build_warm_snapshot(), WARM_SNAPSHOT_FILE):
+            logger.info("Snapshot de warm-start salvo.")
         await runner.cleanup()
         logger.info("Runner do AIOHTTP limpo.")
         # Usa a global coc_client (declarada no início de main)